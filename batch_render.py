@@ -0,0 +1,177 @@
+"""
+GUI を起動せずに、プロジェクトファイルやシードからキャンバスを PNG / SVG に書き出す。
+
+    python batch_render.py a.json b.ldproj -o out --format png --scale 2
+    python batch_render.py --seeds 1-1000 --width 800 --height 600 --count 20 -o out --format svg -j 8
+
+ジョブはプロセスプールで並列に処理する（各プロセスは Qt の offscreen プラットフォームで動く）
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+FORMATS = ('png', 'svg', 'svgz')
+
+_app = None  # プロセスごとの QApplication
+
+def _init_worker():
+    # Canvas は QWidget なので、プロセスごとに画面のない QApplication を1つ作る
+    global _app
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6.QtWidgets import QApplication
+    _app = QApplication.instance() or QApplication([])
+
+def load_canvas(job):
+    """
+    ジョブからキャンバスを作る。job['project'] があればプロジェクトファイル（ジャーナルも再生する）、
+    なければ job['seed'] と大きさ・本数から線を生成する
+    """
+    from canvas import Canvas, Layer, Project
+    from journal import replay_journal
+    from project_io import is_binary_project
+    if job.get('project'):
+        path = job['project']
+        if is_binary_project(path):
+            project = Project.from_binary(path, prepare=False)
+        else:
+            import json
+            with open(path, 'r', encoding='utf-8') as f:
+                project = Project.from_json(json.loads(f.read()), prepare=False)
+        # ジャーナルの領域インデックスはファイルと同じ並びなので、領域を作る前に再生する
+        replay_journal(project, path)
+        project.prepare()
+        # 既定のレイヤーは作らずに、読み込んだレイヤーに置き換える
+        canvas = Canvas(project.width, project.height, grid=project.grid, layers=[])
+        canvas.set_project(project)
+        return canvas
+    layer = Layer("Layer 1")
+    layer.generate(job['width'], job['height'], count=job['count'], seed=job['seed'])
+    return Canvas(job['width'], job['height'], grid=layer.grid, layers=[layer])
+
+def render_job(job):
+    """
+    1つのジョブを書き出し、(出力先, かかった秒数) を返す
+    """
+    if _app is None:
+        _init_worker()
+    start = time.perf_counter()
+    canvas = load_canvas(job)
+    output = job['output']
+    if job['format'] == 'png':
+        canvas.export_png(output, job['scale'], job['antialiasing'])
+    else:
+        canvas.to_svg(output)
+    return output, time.perf_counter() - start
+
+def parse_seeds(text):
+    """
+    "1,5,10-20" のような指定をシードのリストにする
+    """
+    seeds = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            seeds.extend(range(int(first), int(last) + 1))
+        else:
+            seeds.append(int(part))
+    return seeds
+
+def _output_name(path, stems) -> str:
+    # ふつうはファイル名から拡張子を除いたもの。同じ名前のファイルが並んでいたら、パス全体を名前にする（a/x.json -> a_x.json）
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if stems.count(stem) == 1:
+        return stem
+    return os.path.normpath(path).lstrip(os.sep).replace(os.sep, '_').replace(':', '_')
+
+def build_jobs(args):
+    """
+    コマンドライン引数からジョブのリストを作る。2つのジョブの出力先が同じになるときは ValueError
+    """
+    options = {'format': args.format, 'scale': args.scale, 'antialiasing': args.antialias}
+    jobs = []
+    stems = [os.path.splitext(os.path.basename(path))[0] for path in args.projects]
+    for path in args.projects:
+        name = _output_name(path, stems)
+        jobs.append({**options, 'project': path, 'output': os.path.join(args.output_dir, f'{name}.{args.format}')})
+    for seed in args.seeds or []:
+        jobs.append({**options, 'seed': seed, 'width': args.width, 'height': args.height, 'count': args.count,
+                     'output': os.path.join(args.output_dir, f'seed-{seed}.{args.format}')})
+    # 同じファイルを2度指定した場合なども、黙って上書きし合わないようにする
+    outputs = {}
+    for job in jobs:
+        key = os.path.normcase(os.path.abspath(job['output']))
+        if key in outputs:
+            raise ValueError(f"出力先が重なっています: {job['output']}（{_job_source(outputs[key])} と {_job_source(job)}）")
+        outputs[key] = job
+    return jobs
+
+def _job_source(job) -> str:
+    return job['project'] if job.get('project') else f"シード {job['seed']}"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="プロジェクトファイルやシードから、GUI なしで PNG / SVG を書き出す")
+    parser.add_argument('projects', nargs='*', help="プロジェクトファイル（.json / .ldproj）")
+    parser.add_argument('--seeds', type=parse_seeds, help="線を生成するシード（例: 1,5,10-20）")
+    parser.add_argument('--width', type=int, default=800, help="シードから作るキャンバスの幅")
+    parser.add_argument('--height', type=int, default=600, help="シードから作るキャンバスの高さ")
+    parser.add_argument('--count', type=int, default=20, help="シードから作る線の数")
+    parser.add_argument('-o', '--output-dir', default='.', help="出力先のフォルダー")
+    parser.add_argument('-f', '--format', choices=FORMATS, default='png', help="出力形式")
+    parser.add_argument('--scale', type=int, default=1, help="PNG の拡大率")
+    parser.add_argument('--antialias', action='store_true', help="PNG をアンチエイリアシングして描く")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="並列に動かすプロセスの数")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = build_jobs(args)
+    except ValueError as e:
+        parser.error(str(e))
+    if not jobs:
+        parser.error("プロジェクトファイルか --seeds を指定してください。")
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+    failures = 0
+    start = time.perf_counter()
+    if args.jobs <= 1:
+        results = ((job, _run(job)) for job in jobs)
+        for done, (job, result) in enumerate(results, 1):
+            failures += _report(done, len(jobs), job, result)
+    else:
+        import multiprocessing
+        # Qt は fork したプロセスでは安全に使えないので spawn で起動する
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context, initializer=_init_worker) as executor:
+            futures = {executor.submit(render_job, job): job for job in jobs}
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = e
+                failures += _report(done, len(jobs), futures[future], result)
+    elapsed = time.perf_counter() - start
+    print(f"{len(jobs) - failures}/{len(jobs)} 件を {elapsed:.1f} 秒で書き出しました", file=sys.stderr)
+    return 1 if failures else 0
+
+def _run(job):
+    try:
+        return render_job(job)
+    except Exception as e:
+        return e
+
+def _report(done, total, job, result) -> int:
+    # 1件ごとの結果を表示し、失敗なら 1 を返す
+    if isinstance(result, Exception):
+        print(f"[{done}/{total}] 失敗: {job['output']}: {result}", file=sys.stderr)
+        return 1
+    output, seconds = result
+    print(f"[{done}/{total}] {output} ({seconds:.2f} 秒)", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+import threading
+
+class RenderCancelled(Exception):
+    """
+    描画・書き出しが取り消されたときに投げられる
+    """
+
+class CancelToken:
+    """
+    別スレッドの描画・書き出しを止めるための目印。
+    cancel() はどのスレッドから呼んでもよく、描画側はレイヤーの間や図形の束ごとに check() を呼ぶ
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def check(self):
+        """
+        取り消されていれば RenderCancelled を投げる
+        """
+        if self._event.is_set():
+            raise RenderCancelled()
+
+def check_cancelled(cancel: CancelToken = None):
+    """
+    cancel が None でなく取り消されていれば RenderCancelled を投げる
+    """
+    if cancel is not None:
+        cancel.check()
@@ -1,11 +1,28 @@
-from typing import List
+import copy
+import itertools
+import time
+from typing import Dict, List, Tuple
+from PyQt6.QtCore import QRectF
 from PyQt6.QtWidgets import QWidget
 from PyQt6.QtGui import QPainter, QPaintEvent, QPolygonF
 
 from shapely.geometry import LineString, Point, Polygon
-from shapely.ops import unary_union, polygonize
+from shapely.strtree import STRtree
 
-from geom import create_regions, generate_lines, regions_in
+import numpy as np
+import shapely
+
+from cancellation import CancelToken, check_cancelled
+from history import FillChange, History
+from layer_render_cache import LayerRenderCache, checker_brush, damage_rect
+from geom import (
+    DEFAULT_GRID, CentroidIndex, EdgeTable, arrangement_checksum, build_edge_table, chain_segments, clip_segments,
+    create_regions, generate_lines, has_edge_on, inner_segments, line_segments, merge_regions, new_seed, region_shapes,
+    segment_crossings, snap, split_regions
+)
+
+_CANCEL_BATCH = 512  # 取り消しを確かめる間隔（図形の数）
+_numberings = itertools.count(1)  # Layer.numbering の通し番号
 
 class Layer:
     save_mode_enum = [
@@ -17,35 +34,607 @@ class Layer:
         "塗られている領域の外側の線のみを保存し、塗りつぶしは描画しない"
     ]
 
-    def __init__(self, name, visible=True):
+    def __init__(self, name, visible=True, grid=DEFAULT_GRID):
         self.save_mode = 0  # デフォルトの保存モード（通常）
+        self.merge_fills = False  # ベクター保存時に、隣り合う同じ色の塗りを1つの図形にまとめるか
+        self.grid = grid  # 頂点を丸める格子の細かさ（1ピクセルあたりの分割数）
         self.name = name
         self.visible = visible
         self.lines: List[LineString] = None
-        self.colored_regions = []
-        self.regions: List[Polygon] = []  # 領域もレイヤーごとに保持
+        self.fills: Dict[int, Tuple[int, int, int, int]] = {}  # 領域インデックス -> RGBA
+        self._regions: List[Polygon] = []  # 領域（None なら次に使うときに線から作る）
         self.line_rgba = (0, 0, 0, 255)  # 線の色もレイヤーごとに保持
         self.line_width = 2  # 線の太さ（デフォルト2）
+        self.size = None  # 領域を作ったキャンバスの大きさ (w, h)
+        self.geometry_version = 0  # 線・領域が変わるたびに増える
+        self.fill_version = 0  # 塗りが変わるたびに増える
+        self.numbering = next(_numberings)  # 領域インデックスの振り方の番号（インデックスが別の領域を指すようになるたびに変わる）
+        self.fill_damage = []  # 前回描画してから塗りが変わった範囲 (minx, miny, maxx, maxy)。None なら全体
+        self.render_cache = None  # 描画用キャッシュ（LayerRenderCache）
+        self._edge_table: EdgeTable = None  # 辺と左右の領域の表（遅延構築）
+        self._edge_table_version = None
+        self._centroid_index: CentroidIndex = None  # 重心で領域を探す辞書（遅延構築）
+        self._centroid_index_version = None
+        self.seed = None  # 線を生成したシード（線を直接編集した場合は None）
+        self._region_index: STRtree = None  # 領域の空間インデックス（遅延構築）
+        self._region_index_src = None  # インデックス構築に使った regions
+        self._derived_cache = {}  # 書き出し用に作った図形: 名前 -> (作ったときの版, 値)
+        self._regions_canonical = True  # regions が線から作り直したときと同じ並びか（線を足し引きすると崩れる）
+        self._checksum = None  # 領域を作る前から分かっている並びのチェックサム（ファイルから読んだもの、解放前に計算したもの）
+        self._fill_shapes = {}  # 領域を作る前から分かっている塗りの形: 領域インデックス -> [重心 x, 重心 y, 面積, 周長]
+        self.last_used = time.monotonic()  # 最後に領域を使った時刻
+
+    @property
+    def regions(self) -> List[Polygon]:
+        """
+        領域のリスト。まだ作っていない（または解放した）ときは、ここで線から作る。
+        ファイルから読んだ塗りの置き場所が見つからなければ ValueError（塗りは捨てない）
+        """
+        self.last_used = time.monotonic()
+        if self._regions is None:
+            self._build_regions()
+        return self._regions
+
+    @regions.setter
+    def regions(self, regions: List[Polygon]):
+        self._regions = regions
+
+    @property
+    def has_geometry(self) -> bool:
+        """
+        領域が作られているか
+        """
+        return self._regions is not None
+
+    @property
+    def canonical(self) -> bool:
+        """
+        regions が線から作り直したときと同じ並びか（領域インデックスを保存しても読み込み時と同じ領域を指すか）
+        """
+        return self._regions_canonical
+
+    def ensure_geometry(self):
+        """
+        領域を作っておく。ファイルから読んだ塗りが領域と一致しなければ ValueError
+        """
+        self.last_used = time.monotonic()
+        if self._regions is None:
+            self._build_regions()
+
+    def _build_regions(self):
+        regions = create_regions(*self.size, self.lines or [], self.grid) if self.size else []
+        # ファイルから読んだ塗りは、領域を作ったここで初めて確かめる
+        if (self._checksum is not None and arrangement_checksum(regions) != self._checksum) or \
+                (self.fills and max(self.fills) >= len(regions)):
+            # 並びが違っても（GEOS や環境による浮動小数点の違いなど）、塗りの形から領域を探し直せればそれを使う。
+            # 探せなければ塗りはそのまま残して ValueError にする（捨てると次の保存で失われる）
+            self.fills = self._rematch_fills(regions)
+            self.numbering = next(_numberings)
+            self.geometry_version += 1  # 領域インデックスが変わったので、インデックスを持つ側に知らせる
+            self.invalidate_fills()
+        self._regions = regions
+        self._regions_canonical = True
+        self._fill_shapes = {}
+
+    def _rematch_fills(self, regions: List[Polygon]) -> Dict[int, Tuple[int, int, int, int]]:
+        """
+        保存しておいた塗りの形から、regions のうち重心と面積が一致する領域を探し直した塗りを返す。
+        形の分からない塗りや、見つからない塗りがあれば ValueError
+        """
+        ids = list(self.fills)
+        if any(idx not in self._fill_shapes for idx in ids):
+            raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+        found = CentroidIndex(regions, self._match_tolerance()).find_shapes([self._fill_shapes[idx] for idx in ids])
+        if None in found or len(set(found)) != len(found):
+            raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+        return dict(zip(found, self.fills.values()))
+
+    def release_geometry(self):
+        """
+        領域と、そこから作った索引・書き出し用の図形を手放す（線と塗りは残る）。手放したら True を返す。
+        作り直すと線から作った並びになるので、線を足し引きして並びが崩れたレイヤーは手放さない
+        （ここで番号を付け替えると、領域インデックスを持っている履歴やジャーナルとずれる）。
+        画面用のオフスクリーン画像は残すので、表示中のレイヤーでも描き直しが要るまでは作り直さない
+        """
+        if self._regions is None or not self._regions_canonical:
+            return False
+        self._checksum = self.region_checksum()
+        self._fill_shapes = dict(zip(self.fills, self.fill_shapes().tolist()))
+        self._regions = None
+        self._drop_region_caches()
+        return True
+
+    def _drop_region_caches(self):
+        # 領域インデックスに結びついたキャッシュを捨てる
+        self._region_index = None
+        self._region_index_src = None
+        self._edge_table = None
+        self._edge_table_version = None
+        self._centroid_index = None
+        self._centroid_index_version = None
+        self._derived_cache = {}
+        if self.render_cache is not None:
+            self.render_cache.forget_regions()
+
+    def snapshot(self) -> 'Layer':
+        """
+        いまの状態を写し取ったレイヤーを返す（別スレッドでの保存用）。
+        shapely の図形は変更されないので共有し、リストと辞書だけを複製する
+        """
+        layer = copy.copy(self)
+        layer.lines = list(self.lines) if self.lines is not None else None
+        layer.fills = dict(self.fills)
+        layer._regions = list(self._regions) if self._regions is not None else None
+        layer.fill_damage = []
+        layer.render_cache = None
+        layer._region_index = None
+        layer._region_index_src = None
+        layer._centroid_index = None
+        layer._centroid_index_version = None
+        layer._derived_cache = dict(self._derived_cache)
+        return layer
+
+    def set_lines(self, w, h, lines: List[LineString]):
+        """
+        線を設定する。領域は次に使うときに作る
+        """
+        self.size = (w, h)
+        self.seed = None
+        self.lines = lines
+        self._regions = None
+        self._regions_canonical = True
+        self._checksum = None
+        self._fill_shapes = {}
+        self.fills = {}  # 領域が変わるのでインデックスも無効になる
+        self.numbering = next(_numberings)
+        self.geometry_version += 1
+        self.invalidate_fills()
+        self._region_index_src = None
+
+    def generate(self, w, h, count, seed=None):
+        """
+        シードから線を生成して設定する。seed を省略すると新しいシードを使う
+        """
+        if seed is None:
+            seed = new_seed()
+        self.set_lines(w, h, generate_lines(w, h, count=count, seed=seed))
+        self.seed = seed
+
+    def add_line(self, line: LineString) -> Dict[int, int]:
+        """
+        線を1本追加し、その線が横切る領域だけを分割する。
+        線の端や交点が隣の領域の辺の途中に乗るとき（T字）は、その領域の辺もそこで区切る。
+        分割された領域の塗りは、分割後のすべての領域に引き継ぐ。
+        インデックスが変わった（詰めるために動かした）領域の {古いインデックス: 新しいインデックス} を返す
+        """
+        self.lines.append(line)
+        self.seed = None
+        w, h = self.size
+        raw = clip_segments(line_segments([line]), w, h)
+        if len(raw) == 0:
+            self.geometry_version += 1  # 領域は変わらなくても線は変わった
+            return {}
+        segment = snap(raw[0], self.grid)
+        affected = [i for i in self.regions_crossing(LineString(segment))
+                    if not self.regions[i].touches(LineString(segment))]
+        if not affected:
+            self.geometry_version += 1
+            return {}
+        # 既存の線との交点は、全体を作り直したときと同じ計算で求める
+        others = clip_segments(line_segments(self.lines[:-1]), w, h)
+        crossings = segment_crossings(raw[0], others, self.grid)
+        affected += self._regions_through(np.concatenate([crossings.reshape(-1, 2), segment]), affected)
+        parents = [self.regions[i] for i in affected]
+        pieces = split_regions(parents, segment, self.grid, crossings, inner_segments(parents, others, self.grid))
+        fills = []
+        for piece in pieces:
+            pt = piece.representative_point()
+            parent = next((i for i, region in zip(affected, parents) if region.contains(pt)), None)
+            fills.append(self.fills.get(parent))
+        return self._replace_regions(affected, pieces, fills)
+
+    def _regions_through(self, points: np.ndarray, exclude, at_vertex=False) -> List[int]:
+        """
+        exclude 以外の領域のうち、外周が points のどれかを通る領域のインデックスを返す。
+        at_vertex なら頂点として、そうでなければ辺の途中（頂点以外）で通るもの
+        """
+        tolerance = 2.0 / self.grid if self.grid else 1e-7
+        exclude = set(exclude)
+        found = []
+        for point in points:
+            for i in self.regions_crossing(Point(point).buffer(tolerance)):
+                if i in exclude:
+                    continue
+                ring = self.regions[i].exterior
+                if ring.distance(Point(point)) <= tolerance and \
+                        (shapely.get_coordinates(ring) == point).all(axis=1).any() == at_vertex:
+                    exclude.add(i)
+                    found.append(i)
+        return found
+
+    def remove_line(self, index: int) -> Dict[int, int]:
+        """
+        index 番目の線を取り除き、その線で区切られていた領域だけを結合する（線の端が別の線に乗っていたところは、その頂点も除く）。
+        結合後の領域は、元の領域のうち最も面積の大きい塗られた領域の色を引き継ぐ。
+        インデックスが変わった（詰めるために動かした）領域の {古いインデックス: 新しいインデックス} を返す
+        """
+        line = self.lines.pop(index)
+        self.seed = None
+        segment = self._clipped_segment(line)
+        if segment is None:
+            self.geometry_version += 1  # 領域は変わらなくても線は変わった
+            return {}
+        seg = LineString(segment)
+        # 格子に丸めた頂点も、丸めた端点を結んだ線分も、元の線から格子半目ほどずつずれる
+        tolerance = 2.0 / self.grid if self.grid else 1e-7
+        affected = [i for i in self.regions_crossing(seg.buffer(tolerance))
+                    if has_edge_on(self.regions[i], segment, tolerance)]
+        # 線の端が別の線の途中に乗っていた（T字の）ときや、線の先が行き止まりで別の領域に入っていたときは、
+        # その向こう側の領域にも線の上の頂点が残っているので一緒に作り直す
+        coords = shapely.get_coordinates([self.regions[i].exterior for i in affected]).reshape(-1, 2)
+        on_line = coords[shapely.distance(shapely.points(coords), seg) <= tolerance]
+        affected += self._regions_through(np.unique(np.concatenate([segment, on_line]), axis=0), affected, at_vertex=True)
+        if not affected:
+            self.geometry_version += 1
+            return {}
+        parents = [self.regions[i] for i in affected]
+        # 同じ所を通る線が残っていれば、その辺は取り除かない
+        others = clip_segments(line_segments(self.lines), *self.size, self.grid) if self.lines else None
+        merged = merge_regions(parents, segment, tolerance, others)
+        fills = []
+        for region in merged:
+            best = None
+            for i, parent in zip(affected, parents):
+                if i in self.fills and region.contains(parent.representative_point()):
+                    if best is None or parent.area > self.regions[best].area:
+                        best = i
+            fills.append(self.fills.get(best))
+        return self._replace_regions(affected, merged, fills)
+
+    def _clipped_segment(self, line: LineString):
+        w, h = self.size
+        clipped = clip_segments(np.asarray(line.coords, dtype=float).reshape(1, 2, 2), w, h, self.grid)
+        return clipped[0] if len(clipped) else None
+
+    def _replace_regions(self, old_ids: List[int], new_regions: List[Polygon], new_fills) -> Dict[int, int]:
+        """
+        old_ids の領域を new_regions で置き換える。new_regions は old_ids の空きと末尾に入れ、
+        余った空きは末尾の領域を移して詰める。変更のない領域のインデックスは、この移した領域を除いて変わらない。
+        移した領域の {古いインデックス: 新しいインデックス} を返す（インデックスを持つ側はこれで付け替える）
+        """
+        moved = {}
+        for i in old_ids:
+            self.fills.pop(i, None)
+        slots = sorted(old_ids)
+        for region, rgba in zip(new_regions, new_fills):
+            if slots:
+                idx = slots.pop(0)
+                self.regions[idx] = region
+            else:
+                idx = len(self.regions)
+                self.regions.append(region)
+            if rgba is not None:
+                self.fills[idx] = rgba
+        # 余ったインデックスは末尾の領域を移して詰める
+        for idx in sorted(slots, reverse=True):
+            last = len(self.regions) - 1
+            if idx != last:
+                self.regions[idx] = self.regions[last]
+                moved[moved.pop(last, last)] = idx
+                if last in self.fills:
+                    self.fills[idx] = self.fills.pop(last)
+            self.regions.pop()
+        self._region_index_src = None  # インデックスは次の問い合わせで作り直す
+        self._regions_canonical = False
+        self._checksum = None
+        self.numbering = next(_numberings)
+        self.geometry_version += 1
+        self.invalidate_fills()
+        return moved
+
+    def canonicalize(self):
+        """
+        線を足し引きして並びが崩れた regions を、線から作り直したときと同じ並びにそろえる（塗りも付け替える）。
+        塗りを領域インデックスで保存する前に呼ぶ。
+        領域インデックスが変わるので geometry_version を上げる（インデックスを持つ側はこれで持ち直す）
+        """
+        if self._regions_canonical:
+            return
+        painted = [(self.regions[i], rgba) for i, rgba in self.fills.items()]
+        w, h = self.size
+        regions = create_regions(w, h, self.lines or [], self.grid)
+        found = CentroidIndex(regions, self._match_tolerance()).find_many([region for region, _ in painted])
+        if None in found:
+            raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+        # 探し終えてから差し替えるので、失敗しても元の並びと塗りが残る
+        self._regions = regions
+        self._regions_canonical = True
+        self._drop_region_caches()
+        self.fills = {idx: rgba for idx, (_, rgba) in zip(found, painted)}
+        self.numbering = next(_numberings)
+        self.geometry_version += 1
+        self.invalidate_fills()
+
+    def rebuild_region_index(self):
+        """
+        領域の空間インデックス（STRtree）を作り直す
+        """
+        self._region_index = STRtree(self.regions) if self.regions else None
+        self._region_index_src = self.regions
+
+    def _ensure_region_index(self):
+        # regions が差し替えられていたらインデックスも作り直す
+        if self._region_index_src is not self.regions:
+            self.rebuild_region_index()
+        return self._region_index
+
+    def region_at(self, x, y):
+        """
+        点(x, y)を含む領域のインデックスを返す。なければ None
+        """
+        index = self._ensure_region_index()
+        if index is None:
+            return None
+        hits = index.query(Point(x, y), predicate='within')
+        return int(hits.min()) if len(hits) else None
+
+    def regions_crossing(self, geom) -> List[int]:
+        """
+        geom と交差する領域のインデックスを昇順で返す
+        """
+        index = self._ensure_region_index()
+        if index is None:
+            return []
+        return sorted(int(i) for i in index.query(geom, predicate='intersects'))
+
+    def region_id_of(self, polygon: Polygon):
+        """
+        polygon と一致する領域のインデックスを返す。なければ None
+        """
+        return self.region_ids_of([polygon])[0]
+
+    def region_ids_of(self, polygons: List[Polygon]) -> List[int]:
+        """
+        polygons のそれぞれと一致する領域のインデックス（なければ None）を返す。
+        重心を振り分けた辞書で、重心と面積が格子十数目分の誤差で一致する領域（複数あれば重心が最も近いもの）を探すので、
+        格子に乗っていない古いファイルの座標でも総当たりせずに対応づけられる
+        """
+        if self._centroid_index_version != self.geometry_version or self._centroid_index is None:
+            self._centroid_index = CentroidIndex(self.regions, self._match_tolerance())
+            self._centroid_index_version = self.geometry_version
+        return self._centroid_index.find_many(polygons)
+
+    def _match_tolerance(self) -> float:
+        # 浅い角度の交点は丸め方の違いで線に沿って大きめにずれるので、格子1目より広めに許す
+        return 16.0 / self.grid if self.grid else 1e-6
+
+    def paint_region(self, idx: int, rgba) -> bool:
+        """
+        領域を塗る（既に塗られていれば色を置き換える）。色が変わったら True を返す
+        """
+        rgba = tuple(rgba)
+        self.ensure_geometry()  # idx は作った領域のインデックス（作るときに塗りを探し直すことがあるので先に作る）
+        if self.fills.get(idx) == rgba:
+            return False
+        self.fills[idx] = rgba
+        self.fill_version += 1
+        if self.fill_damage is not None:
+            self.fill_damage.append(self.regions[idx].bounds)
+            if len(self.fill_damage) > 1024:
+                self.fill_damage = None  # 多すぎるときは全体を描き直す
+        return True
+
+    def invalidate_fills(self):
+        """
+        塗りがまとめて変わったことを知らせる（次の描画ではレイヤー全体を描き直す）
+        """
+        self.fill_version += 1
+        self.fill_damage = None
+
+    def set_fills(self, ids, rgba, checksum=None, shapes=None):
+        """
+        保存された塗り（領域インデックスと RGBA の並び）をまとめて設定する。
+        checksum があれば領域の並びが保存時と同じかを確かめる（領域数に比例する時間で済む）。
+        並びが違っていても、shapes（fill_shapes の形）があれば重心で領域を探し直す
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if len(ids) and ids.min() < 0:
+            raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+        self.fills = dict(zip(ids.tolist(), map(tuple, np.asarray(rgba, dtype=np.int64).reshape(-1, 4).tolist())))
+        self._fill_shapes = {}
+        if shapes is not None and len(shapes) == len(ids):
+            self._fill_shapes = dict(zip(ids.tolist(), np.asarray(shapes, dtype=np.float64).reshape(-1, 4).tolist()))
+        self.invalidate_fills()
+        if self._regions is None:
+            # 領域はまだ作らない。チェックサムとインデックスの範囲は領域を作るときに確かめる
+            self._checksum = checksum
+            return
+        if (checksum is not None and checksum != self.region_checksum()) or (len(ids) and ids.max() >= len(self._regions)):
+            self.fills = self._rematch_fills(self._regions)
+        self._fill_shapes = {}
+
+    def update_fills(self, changes: Dict[int, Tuple[int, int, int, int]], shapes: Dict[int, list] = None):
+        """
+        塗りの変更 {領域インデックス: RGBA（None なら塗りを消す）} をまとめて反映する。
+        領域をまだ作っていないときは、shapes（{領域インデックス: fill_shapes の形}）があれば一緒に覚えておき、
+        領域を作ったときに並びが違っていても塗りの置き場所を探し直せるようにする
+        """
+        if self._regions is not None and changes and max(changes) >= len(self._regions):
+            raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+        for idx, rgba in changes.items():
+            if rgba is None:
+                self.fills.pop(idx, None)
+            else:
+                self.fills[idx] = tuple(rgba)
+            if self._regions is None:
+                if rgba is not None and shapes and idx in shapes:
+                    self._fill_shapes[idx] = list(shapes[idx])
+                elif rgba is None:
+                    self._fill_shapes.pop(idx, None)
+        if self._regions is None or self.fill_damage is None or len(self.fill_damage) + len(changes) > 1024:
+            self.invalidate_fills()  # 多すぎるときは全体を描き直す
+        else:
+            self.fill_version += 1
+            self.fill_damage.extend(self._regions[idx].bounds for idx in changes)
+
+    def region_checksum(self) -> str:
+        """
+        領域の並びのチェックサム（塗りを領域インデックスで保存するときに一緒に保存する）
+        """
+        if self._regions is None and self._checksum is not None:
+            return self._checksum
+        return self.derived('region_checksum', self.geometry_version, lambda: arrangement_checksum(self.regions))
+
+    def fill_shapes(self, ids=None) -> np.ndarray:
+        """
+        塗られている領域ごとの [重心 x, 重心 y, 面積, 周長]（fills の順）。ids を渡すとその領域のもの（ids の順）。
+        塗りと一緒に保存しておけば、読み込んだ環境で領域の並びが変わっていても塗りの置き場所を探し直せる
+        """
+        if self._regions is None:
+            wanted = list(self.fills) if ids is None else list(ids)
+            if all(idx in self._fill_shapes for idx in wanted):
+                return np.array([self._fill_shapes[idx] for idx in wanted], dtype=np.float64).reshape(-1, 4)
+        # 領域を先に作る（ファイルの塗りを探し直すと、fills の領域インデックスが入れ替わる）
+        regions = self.regions
+        if ids is not None:
+            return region_shapes([regions[idx] for idx in ids])
+        ids = list(self.fills)
+        return self.derived('fill_shapes', self.fill_key(), lambda: region_shapes([regions[idx] for idx in ids]))
+
+    def colored_regions(self):
+        """
+        塗られている (領域, RGBA) を塗った順に返す
+        """
+        regions = self.regions  # fill_shapes と同じく、fills を読む前に領域を作る
+        return [(regions[i], rgba) for i, rgba in self.fills.items()]
+
+    def derived(self, name, key, build):
+        """
+        書き出し用に作った図形を name ごとに覚えておき、key（作ったときの版）が同じなら作り直さずに返す。
+        返した値は書き換えないこと
+        """
+        entry = self._derived_cache.get(name)
+        if entry is None or entry[0] != key:
+            entry = (key, build())
+            self._derived_cache[name] = entry
+        return entry[1]
+
+    def fill_key(self):
+        """
+        塗りから作る図形の版（線・領域と塗りが変わると変わる）
+        """
+        return (self.geometry_version, self.fill_version)
+
+    def line_key(self):
+        """
+        書き出す線の版。塗りに応じて線を選ぶ保存モードのときだけ塗りの版も含める
+        """
+        fill_version = self.fill_version if self.save_mode in (1, 2, 4, 5) else None
+        return (self.geometry_version, self.save_mode, fill_version)
+
+    def export_fills(self) -> List[Tuple[Polygon, Tuple[int, int, int, int]]]:
+        """
+        書き出す (図形, RGBA) を返す。merge_fills なら同じ色の領域を色ごとに1つにまとめる（穴があることもある）
+        """
+        if not self.merge_fills:
+            return self.colored_regions()
+        self.ensure_geometry()  # 塗りを探し直すと版が上がるので、版を読む前に領域を作る
+        return self.derived('merged_fills', self.fill_key(), self._merge_fills)
+
+    def _merge_fills(self):
+        by_color = {}
+        for i, rgba in self.fills.items():
+            by_color.setdefault(tuple(rgba), []).append(self.regions[i])
+        result = []
+        for rgba, polygons in by_color.items():
+            # 領域は辺を共有して重ならないので、coverage_union でそのまま溶かせる
+            merged = shapely.coverage_union_all(polygons)
+            result.extend((polygon, rgba) for polygon in shapely.get_parts(merged) if isinstance(polygon, Polygon))
+        return result
+
+    def colored_polygons(self) -> List[Polygon]:
+        regions = self.regions
+        return [regions[i] for i in self.fills]
+
+    def edge_table(self) -> EdgeTable:
+        """
+        辺と左右の領域の表を返す（線・領域が変わったときだけ作り直す）
+        """
+        if self._edge_table_version != self.geometry_version:
+            self._edge_table = build_edge_table(self.regions, self.grid)
+            self._edge_table_version = self.geometry_version
+        return self._edge_table
+
+    def export_segments(self) -> np.ndarray:
+        """
+        保存モードに応じて書き出す線を、線分の (M, 2, 2) 配列で返す
+        """
+        return self.derived('segments', self.line_key(), self._export_segments)
+
+    def _export_segments(self) -> np.ndarray:
+        if self.save_mode == 0:
+            return line_segments(self.lines or [])
+        if self.save_mode in (1, 2):
+            return self.edge_table().touching(self.fills.keys())
+        if self.save_mode in (4, 5):
+            return self.edge_table().outside(self.fills.keys())
+        # 塗りつぶしだけの場合は線は描画しない
+        return np.empty((0, 2, 2))
+
+    def export_polylines(self) -> List[List[tuple]]:
+        """
+        保存モードに応じて書き出す線を、つながっているものどうしで折れ線にまとめて返す
+        """
+        def build():
+            segments = self.export_segments()
+            if len(segments) == 0:
+                return []
+            return chain_segments(segments, self.grid)
+        return self.derived('polylines', self.line_key(), build)
+
+    def boundary_edges(self) -> List[LineString]:
+        """
+        塗られている領域に接する辺を返す
+        """
+        return list(shapely.linestrings(self.edge_table().touching(self.fills.keys())))
+
+    def outside_edges(self) -> List[LineString]:
+        """
+        塗られている領域の外側の辺（塗られた領域どうしで共有していない辺）を返す
+        """
+        return list(shapely.linestrings(self.edge_table().outside(self.fills.keys())))
 
     @staticmethod
-    def from_json(w, h, data):
+    def from_json(w, h, data, grid=DEFAULT_GRID):
         """
         JSONからレイヤー情報を復元する
         """
-        layer = Layer(data['name'], visible=data.get('visible', True))
+        layer = Layer(data['name'], visible=data.get('visible', True), grid=grid)
         layer.save_mode = data.get('save_mode', 0)
-        layer.lines = [LineString(line) for line in data.get('lines', [])]
-        layer.regions = create_regions(w, h, layer.lines)
+        layer.merge_fills = data.get('merge_fills', False)
+        if 'lines' not in data and data.get('seed') is not None:
+            # 線が保存されていなければシードから作り直す
+            layer.generate(w, h, data.get('line_count', 0), seed=data['seed'])
+        else:
+            layer.set_lines(w, h, [LineString(line) for line in data.get('lines', [])])
+            layer.seed = data.get('seed')
 
-        layer.colored_regions = [
-            (Polygon(colored_region["coords"]), tuple(colored_region["rgba"])) for colored_region in data.get('colored_regions', [])
-        ] if data.get('colored_regions') else []
         layer.line_rgba = tuple(data.get('line_rgba', (0, 0, 0, 255)))
         layer.line_width = data.get('line_width', 2)
 
-        # 領域と色付き領域の整合性を確認
-        if not regions_in(layer.regions, [r for r, _ in layer.colored_regions]):
-            raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+        if 'fill_ids' in data:
+            # 塗りは領域インデックスで保存されている。並びのチェックサムで整合性を確かめる
+            layer.set_fills(data['fill_ids'], data.get('fill_rgba', []), data.get('region_checksum'), data.get('fill_shapes'))
+        else:
+            # 古い形式：色付き領域の座標から、領域インデックスに変換
+            colored_regions = data.get('colored_regions') or []
+            regions = [Polygon(colored_region["coords"]) for colored_region in colored_regions]
+            for idx, region, colored_region in zip(layer.region_ids_of(regions), regions, colored_regions):
+                if idx is None:
+                    if grid and 2 * region.area < region.length / grid:
+                        continue  # 格子1目より細い領域は丸めでつぶれて存在しない
+                    raise ValueError("色付き領域がレイヤーの領域と一致しません。")
+                layer.paint_region(idx, tuple(colored_region["rgba"]))
 
         return layer
         
@@ -58,37 +647,210 @@ class Layer:
                 return []
             return [list(line.coords) for line in lines if hasattr(line, 'coords')]
 
-        def colored_regions_to_list(colored_regions):
-            return [
-                {
-                    'coords': list(region.exterior.coords),
-                    'rgba': rgba
-                }
-                for region, rgba in colored_regions if hasattr(region, 'exterior')
-            ]
-
+        self.canonicalize()
         return {
             'name': self.name,
             'visible': self.visible,
             'save_mode': self.save_mode,
+            'merge_fills': self.merge_fills,
             'lines': lines_to_list(self.lines),
-            'colored_regions': colored_regions_to_list(self.colored_regions),
+            'seed': self.seed,
+            'line_count': len(self.lines) if self.lines else 0,
+            'fill_ids': list(self.fills.keys()),
+            'fill_rgba': [list(rgba) for rgba in self.fills.values()],
+            'region_checksum': self.region_checksum(),
+            'fill_shapes': np.round(self.fill_shapes(), 4).tolist(),
             'line_rgba': self.line_rgba,
             'line_width': self.line_width
         }
 
+    def to_arrays(self):
+        """
+        バイナリ保存用に (JSON にできるレイヤー情報の dict, 配列の dict) を返す。
+        線は座標の配列と各線の開始位置、塗りは領域インデックスと RGBA の配列にする
+        """
+        self.canonicalize()
+        lines = self.lines or []
+        if lines:
+            coords, index = shapely.get_coordinates(np.asarray(lines, dtype=object), return_index=True)
+        else:
+            coords, index = np.empty((0, 2)), np.empty(0, dtype=np.int64)
+        offsets = np.searchsorted(index, np.arange(len(lines) + 1))
+        meta = {
+            'name': self.name,
+            'visible': self.visible,
+            'save_mode': self.save_mode,
+            'merge_fills': self.merge_fills,
+            'seed': self.seed,
+            'line_count': len(lines),
+            'region_checksum': self.region_checksum(),
+            'line_rgba': list(self.line_rgba),
+            'line_width': self.line_width
+        }
+        arrays = {
+            'line_coords': coords.astype(np.float64),
+            'line_offsets': offsets.astype(np.int64),
+            'fill_ids': np.fromiter(self.fills.keys(), dtype=np.int32, count=len(self.fills)),
+            'fill_rgba': np.array(list(self.fills.values()), dtype=np.uint8).reshape(-1, 4),
+            'fill_shapes': self.fill_shapes()
+        }
+        return meta, arrays
+
+    @staticmethod
+    def from_arrays(w, h, meta, arrays, grid=DEFAULT_GRID):
+        """
+        to_arrays の形からレイヤーを復元する
+        """
+        layer = Layer(meta['name'], visible=meta.get('visible', True), grid=grid)
+        layer.save_mode = meta.get('save_mode', 0)
+        layer.merge_fills = meta.get('merge_fills', False)
+        layer.line_rgba = tuple(meta.get('line_rgba', (0, 0, 0, 255)))
+        layer.line_width = meta.get('line_width', 2)
+        offsets = np.asarray(arrays['line_offsets'])
+        lines = []
+        if len(offsets) > 1:
+            indices = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            lines = list(shapely.linestrings(np.asarray(arrays['line_coords']), indices=indices))
+        layer.set_lines(w, h, lines)
+        layer.seed = meta.get('seed')
+
+        layer.set_fills(arrays['fill_ids'], arrays['fill_rgba'], meta.get('region_checksum'), arrays.get('fill_shapes'))
+        return layer
+
+class Project:
+    """
+    キャンバスの大きさ・格子・レイヤーをまとめたもの。
+    QWidget から切り離してあるので、別スレッドで読み込みや保存ができる
+    """
+
+    def __init__(self, width, height, grid, layers: List[Layer], journal_id=None, journal_seq=0):
+        self.width = width
+        self.height = height
+        self.grid = grid
+        self.layers = layers
+        self.journal_id = journal_id  # 対になるジャーナルの id（journal.Journal.token）
+        self.journal_seq = journal_seq  # ジャーナルのうち、このプロジェクトに入っている最後の操作の通し番号
+
+    @staticmethod
+    def from_json(data, progress_callback=None, prepare=True):
+        """
+        JSON から復元する。表示中のレイヤーは領域まで作って塗りを確かめる。
+        ジャーナルを再生するときは prepare=False で読み、再生してから prepare を呼ぶ
+        """
+        grid = data.get('grid', DEFAULT_GRID)
+        layers_data = data.get('layers', [])
+        layers = []
+        for i, layer_data in enumerate(layers_data):
+            layers.append(Layer.from_json(data['width'], data['height'], layer_data, grid))
+            if progress_callback and not prepare:
+                progress_callback((i + 1) / len(layers_data))
+        project = Project(data['width'], data['height'], grid, layers, data.get('journal_id'), data.get('journal_seq', 0))
+        if prepare:
+            project.prepare(progress_callback)
+        return project
+
+    @staticmethod
+    def from_binary(path, progress_callback=None, prepare=True):
+        """
+        バイナリ形式（project_io）のファイルから復元する。prepare は from_json と同じ
+        """
+        from project_io import read_project
+        header, arrays = read_project(path)
+        grid = header.get('grid', DEFAULT_GRID)
+        metas = header.get('layers', [])
+        layers = []
+        for i, meta in enumerate(metas):
+            layer_arrays = {name.rsplit('/', 1)[1]: array for name, array in arrays.items() if name.startswith(f'layers/{i}/')}
+            layers.append(Layer.from_arrays(header['width'], header['height'], meta, layer_arrays, grid))
+            if progress_callback and not prepare:
+                progress_callback((i + 1) / len(metas))
+        project = Project(header['width'], header['height'], grid, layers, header.get('journal_id'), header.get('journal_seq', 0))
+        if prepare:
+            project.prepare(progress_callback)
+        return project
+
+    def prepare(self, progress_callback=None):
+        """
+        表示中のレイヤーはすぐ描くので、ここで領域を作って塗りを確かめる（非表示のレイヤーは使うときに作る）
+        """
+        for i, layer in enumerate(self.layers):
+            if layer.visible:
+                layer.ensure_geometry()
+            if progress_callback:
+                progress_callback((i + 1) / len(self.layers))
+
+    def to_json(self, progress_callback=None):
+        """
+        JSONシリアライズ可能なdictで返す
+        """
+        layers = []
+        for i, layer in enumerate(self.layers):
+            layers.append(layer.to_json())
+            if progress_callback:
+                progress_callback((i + 1) / len(self.layers))
+        return {
+            'width': self.width,
+            'height': self.height,
+            'grid': self.grid,
+            'journal_id': self.journal_id,
+            'journal_seq': self.journal_seq,
+            'layers': layers
+        }
+
+    def write_binary(self, path, progress_callback=None):
+        """
+        バイナリ形式（project_io）で書き出す
+        """
+        from project_io import write_project
+        header = {'width': self.width, 'height': self.height, 'grid': self.grid,
+                  'journal_id': self.journal_id, 'journal_seq': self.journal_seq, 'layers': []}
+        arrays = {}
+        for i, layer in enumerate(self.layers):
+            meta, layer_arrays = layer.to_arrays()
+            header['layers'].append(meta)
+            for name, array in layer_arrays.items():
+                arrays[f'layers/{i}/{name}'] = array
+            if progress_callback:
+                progress_callback((i + 1) / len(self.layers))
+        write_project(path, header, arrays)
+
+    def save(self, path, progress_callback=None):
+        """
+        拡張子に応じて JSON かバイナリ形式で保存する。
+        一時ファイルに書いてから差し替えるので、途中で失敗しても元のファイルは残る
+        """
+        import json
+        from project_io import atomic_replace, is_binary_project
+        # 書き出しの前のレイヤーの変換に 9 割、書き込みに 1 割を割り当てる
+        layer_progress = (lambda value: progress_callback(value * 0.9)) if progress_callback else None
+        with atomic_replace(path) as tmp:
+            if is_binary_project(path):
+                self.write_binary(tmp, layer_progress)
+            else:
+                text = json.dumps(self.to_json(layer_progress), ensure_ascii=False, indent=2)
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(text)
+        if progress_callback:
+            progress_callback(1.0)
+
 class Canvas(QWidget):
-    def __init__(self, width=800, height=600, parent=None):
+    def __init__(self, width=800, height=600, parent=None, grid=DEFAULT_GRID, layers: List[Layer] = None):
+        """
+        layers を省くと、線20本のレイヤーを1つ作って始める
+        """
         super().__init__(parent)
+        self.grid = grid  # レイヤーの頂点を丸める格子の細かさ（キャンバスごとに設定）
         self.setFixedSize(width, height)
         self.setStyleSheet("background-color: white;")
-        self.layers = [Layer("Layer 1")]
+        if layers is None:
+            layers = [Layer("Layer 1", grid=grid)]
+            layers[0].generate(width, height, count=20)
+        self.layers = layers
         self.active_layer = 0
-        initial_lines = generate_lines(width, height, count=20)
-        self.layers[0].lines = initial_lines
-        self.layers[0].regions = create_regions(width, height, initial_lines)
         self.selected_region = None
         self.colored_regions = []    # 塗りつぶした領域のリスト
+        self.history = History()  # 元に戻す／やり直しの履歴
+        self._stroke: FillChange = None  # ドラッグ中に変えた塗り
         # 親(MainWindow)からRGBA値を参照
         self.selected_rgba = (255, 0, 0, 255)
         if parent and hasattr(parent, "parent") and hasattr(parent.parent(), "color_rgba"):
@@ -106,6 +868,8 @@ class Canvas(QWidget):
         self._dragging = True
         self._prev_pos = (event.position().x() if hasattr(event, 'position') else event.x(),
                           event.position().y() if hasattr(event, 'position') else event.y())
+        # 離すまでに変えた塗りを1つの履歴にまとめる
+        self._stroke = FillChange(self.layers[self.active_layer])
         self._color_region_at_event(event)
 
     def mouseMoveEvent(self, event):
@@ -116,356 +880,438 @@ class Canvas(QWidget):
             prev_x, prev_y = getattr(self, '_prev_pos', (x, y))
             drag_line = LineString([(prev_x, prev_y), (x, y)])
             layer = self.layers[self.active_layer]
-            colored = False
-            for region in layer.regions:
-                if region.intersects(drag_line):
-                    # 塗りつぶし
-                    for i, (rgn, _) in enumerate(layer.colored_regions):
-                        if region.equals(rgn):
-                            layer.colored_regions[i] = (region, self.get_rgba())
-                            break
-                    else:
-                        layer.colored_regions.append((region, self.get_rgba()))
-                    colored = True
-            if colored:
-                self.update()
+            changed = []
+            for idx in layer.regions_crossing(drag_line):
+                # 塗りつぶし
+                if self._paint_region(layer, idx, self.get_rgba()):
+                    changed.append(idx)
+            self._update_regions(layer, changed)
             self._prev_pos = (x, y)
 
     def mouseReleaseEvent(self, event):
         # ドラッグ終了
         self._dragging = False
         self._prev_pos = None
+        if self._stroke is not None and self._stroke.finish():
+            self.history.push(self._stroke)
+        self._stroke = None
+
+    def _paint_region(self, layer, idx, rgba) -> bool:
+        # 領域を塗り、変わったらストロークに記録する
+        old = layer.fills.get(idx)
+        if not layer.paint_region(idx, rgba):
+            return False
+        if self._stroke is not None and self._stroke.layer is layer:
+            self._stroke.record(idx, old, tuple(rgba))
+        return True
+
+    def undo(self):
+        """
+        直前の変更を元に戻す（もう無いレイヤーへの変更は捨てる）
+        """
+        self.history.retain(self.layers)
+        if self.history.undo() is not None:
+            self.update()
+
+    def redo(self):
+        """
+        元に戻した変更をやり直す
+        """
+        self.history.retain(self.layers)
+        if self.history.redo() is not None:
+            self.update()
 
     def _color_region_at_event(self, event):
         x = event.position().x() if hasattr(event, 'position') else event.x()
         y = event.position().y() if hasattr(event, 'position') else event.y()
-        pt = Point(x, y)
         layer = self.layers[self.active_layer]
-        if hasattr(layer, 'regions'):
-            for region in layer.regions:
-                if region.contains(pt):
-                    self.selected_region = region
-                    for i, (rgn, _) in enumerate(layer.colored_regions):
-                        if region.equals(rgn):
-                            layer.colored_regions[i] = (region, self.get_rgba())
-                            break
-                    else:
-                        layer.colored_regions.append((region, self.get_rgba()))
-                    self.update()
-                    break
-            else:
-                self.selected_region = None
-                self.update()
+        idx = layer.region_at(x, y)
+        if idx is not None:
+            self.selected_region = layer.regions[idx]
+            if self._paint_region(layer, idx, self.get_rgba()):
+                self._update_regions(layer, [idx])
+        else:
+            self.selected_region = None
+
+    def _update_regions(self, layer, region_ids):
+        """
+        塗りが変わった領域を囲む範囲だけを再描画する
+        """
+        if not region_ids:
+            return
+        bounds = [layer.regions[i].bounds for i in region_ids]
+        self.update(damage_rect(bounds, layer.line_width))
 
     def paintEvent(self, event: QPaintEvent):
-        from PyQt6 import QtCore
-        from PyQt6.QtCore import Qt
-        from PyQt6.QtGui import QColor, QPen
         painter = QPainter(self)
-        # --- 下層: αチェッカー（市松模様） ---
-        checker_size = 20
-        color1 = Qt.GlobalColor.lightGray
-        color2 = Qt.GlobalColor.white
         w, h = self.width(), self.height()
-        for y in range(0, h, checker_size):
-            for x in range(0, w, checker_size):
-                if ((x // checker_size) + (y // checker_size)) % 2 == 0:
-                    painter.setBrush(color1)
-                else:
-                    painter.setBrush(color2)
-                painter.setPen(Qt.GlobalColor.transparent)
-                painter.drawRect(x, y, checker_size, checker_size)
+        # --- 下層: αチェッカー（市松模様） ---
+        painter.fillRect(0, 0, w, h, checker_brush())
         # --- 上層: 塗り領域・線 ---
-        # 各レイヤーを描画
+        # 各レイヤーは自分のオフスクリーン画像に描いておき、ここでは重ねるだけ
+        dpr = self.devicePixelRatioF()
+        rect = event.rect()
+        painter.setClipRect(rect)
         for idx, layer in enumerate(self.layers):
             if not layer.visible:
                 continue
-            for region, rgba in layer.colored_regions:
-                coords = region.exterior.coords
-                r, g, b, a = rgba
-                qcolor = QColor(r, g, b, a)
+            surface = LayerRenderCache.of(layer).surface(w, h, dpr)
+            painter.drawImage(QRectF(rect), surface, QRectF(rect.x() * dpr, rect.y() * dpr,
+                                                        rect.width() * dpr, rect.height() * dpr))
+
+    def to_svg(self, path, precision=1, compress=None, progress_callback=None, cancel: CancelToken = None):
+        """
+        SVG をファイルに少しずつ書き出す（拡張子が .svgz なら gzip 圧縮）。
+        レイヤーごとに <g> を作り、同じ色の塗りと線はスタイルを共有する。
+        一時ファイルに書いてから差し替えるので、cancel が取り消されたり途中で失敗したりしても元のファイルは残る
+        （取り消されたときは RenderCancelled を投げる）
+        """
+        from project_io import atomic_replace
+        from svg_writer import SvgWriter, svg_color
+        layers = [(idx, layer) for idx, layer in enumerate(self.layers) if layer.visible]
+        if compress is None:
+            compress = str(path).lower().endswith('.svgz')  # 一時ファイルの名前からは決められない
+        with atomic_replace(path) as tmp:
+            with SvgWriter(tmp, self.width(), self.height(), precision=precision, compress=compress) as svg:
+                for done, (idx, layer) in enumerate(layers):
+                    check_cancelled(cancel)
+                    if progress_callback:
+                        progress_callback(done / len(layers))
+                    mode = getattr(layer, 'save_mode', 0)
+                    svg.begin_group(id=f'layer-{idx}')
+                    # 塗り領域（色ごとにまとめる）
+                    if mode in (0, 1, 3, 4):  # 通常, 接する線のみ, 塗りつぶしだけ, 外側の線のみ
+                        by_color = {}
+                        for region, rgba in layer.export_fills():
+                            by_color.setdefault(tuple(rgba), []).append(region)
+                        for rgba, polygons in by_color.items():
+                            fill = svg_color(rgba)
+                            svg.begin_group(style=f'fill:{fill};fill-rule:evenodd;stroke:{fill};stroke-width:1')
+                            for i, polygon in enumerate(polygons):
+                                if i % _CANCEL_BATCH == 0:
+                                    check_cancelled(cancel)
+                                svg.polygon(polygon)
+                            svg.end_group()
+                    # 線（つながっている線は折れ線にまとめる。塗りつぶしだけのモードでは空）
+                    polylines = layer.export_polylines()
+                    if polylines:
+                        svg.begin_group(style=f'stroke:{svg_color(layer.line_rgba)};stroke-width:{layer.line_width};fill:none')
+                        for start in range(0, len(polylines), _CANCEL_BATCH):
+                            check_cancelled(cancel)
+                            svg.paths(polylines[start:start + _CANCEL_BATCH])
+                        svg.end_group()
+                    svg.end_group()
+        if progress_callback: progress_callback(1.0)
+
+    def to_qimage(self, antialiasing=False, progress_callback=None, parallel=False, max_workers=None, cancel: CancelToken = None):
+        """
+        キャンバスを画像にする。
+        parallel=True なら見えているレイヤーをそれぞれ別の画像にスレッドプールで描き、下から順に重ねる。
+        cancel が取り消されると RenderCancelled を投げる
+        """
+        from PyQt6.QtGui import QImage
+        from PyQt6.QtCore import Qt
+        image = QImage(self.width(), self.height(), QImage.Format.Format_ARGB32)
+        image.fill(Qt.GlobalColor.transparent)
+        layers = [layer for layer in self.layers if layer.visible]
+        self._compose_layers(image, layers, lambda painter, layer: self._paint_layer(painter, layer, antialiasing, cancel=cancel),
+                             progress_callback, parallel, max_workers)
+        if progress_callback: progress_callback(1.0)
+        return image
+
+    @staticmethod
+    def _compose_layers(image, layers, paint, progress_callback=None, parallel=False, max_workers=None):
+        """
+        layers を下から順に image に描く。paint(painter, layer) が1つのレイヤーを描く。
+        parallel=True なら各レイヤーを image と同じ大きさの別の画像にスレッドプールで描き、下から順に重ねる
+        """
+        from PyQt6.QtGui import QImage, QPainter
+        from PyQt6.QtCore import Qt
+        if parallel and len(layers) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            import os
+            import threading
+            lock = threading.Lock()
+            done = [0]
+
+            def render(layer):
+                # QImage への QPainter 描画は GUI スレッド以外でもできる
+                layer_image = QImage(image.width(), image.height(), QImage.Format.Format_ARGB32_Premultiplied)
+                layer_image.fill(Qt.GlobalColor.transparent)
+                layer_painter = QPainter(layer_image)
+                try:
+                    paint(layer_painter, layer)
+                finally:
+                    layer_painter.end()
+                if progress_callback:
+                    with lock:
+                        done[0] += 1
+                        progress_callback(done[0] / (len(layers) + 1))
+                return layer_image
+
+            workers = max_workers or min(len(layers), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                layer_images = list(pool.map(render, layers))
+            # 下のレイヤーから順に重ねる
+            painter = QPainter(image)
+            for layer_image in layer_images:
+                painter.drawImage(0, 0, layer_image)
+            painter.end()
+        else:
+            painter = QPainter(image)
+            try:
+                for idx, layer in enumerate(layers):
+                    if progress_callback:
+                        progress_callback(idx / len(layers))
+                    paint(painter, layer)
+            finally:
+                painter.end()
+
+    @staticmethod
+    def _layer_primitives(layer: Layer):
+        """
+        レイヤーの書き出す図形を QPolygonF にしたものと、その外接矩形の配列を返す
+        (塗りの外接矩形, [(QPolygonF, QColor)], 線の外接矩形, [QPolygonF])。
+        レイヤーが変わるまでは作ったものを使い回す
+        """
+        return layer.derived('primitives', (layer.fill_key(), layer.line_key()), lambda: Canvas._build_layer_primitives(layer))
+
+    @staticmethod
+    def _build_layer_primitives(layer: Layer):
+        from PyQt6.QtGui import QColor, QPolygonF
+        from PyQt6.QtCore import QPointF
+        mode = getattr(layer, 'save_mode', 0)
+        fill_bounds, fills = np.empty((0, 4)), []
+        # 塗り領域
+        if mode in (0, 1, 3, 4):  # 通常, 接する線のみ, 塗りつぶしだけ, 外側の線のみ
+            colored = layer.colored_regions()
+            if colored:
+                fill_bounds = shapely.bounds([region for region, _ in colored])
+            for region, rgba in colored:
+                rr, gg, bb, aa = rgba
+                fills.append((QPolygonF([QPointF(x, y) for x, y in region.exterior.coords]), QColor(rr, gg, bb, aa)))
+        # 線（つながっている線は折れ線にまとめて描く。塗りつぶしだけのモードでは空）
+        polylines = layer.export_polylines()
+        line_bounds = np.empty((0, 4))
+        if polylines:
+            line_bounds = np.array([(*np.min(poly, axis=0), *np.max(poly, axis=0)) for poly in map(np.asarray, polylines)])
+        lines = [QPolygonF([QPointF(int(x), int(y)) for x, y in poly]) for poly in polylines]
+        return fill_bounds, fills, line_bounds, lines
+
+    @staticmethod
+    def _paint_layer(painter, layer: Layer, antialiasing=False, primitives=None, rect=None, cancel: CancelToken = None):
+        """
+        1つのレイヤーの塗りと線を painter に描く。
+        rect (x0, y0, x1, y1) を渡すと、その範囲にかかる図形だけを描く。
+        cancel は図形の束ごとに確かめる
+        """
+        from PyQt6.QtGui import QPainter, QColor, QPen
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, antialiasing)
+        check_cancelled(cancel)
+        fill_bounds, fills, line_bounds, lines = primitives or Canvas._layer_primitives(layer)
+        margin = layer.line_width / 2 + 1
+
+        def visible(bounds):
+            if rect is None:
+                return range(len(bounds))
+            x0, y0, x1, y1 = rect
+            hit = (bounds[:, 0] <= x1 + margin) & (bounds[:, 2] >= x0 - margin) & (bounds[:, 1] <= y1 + margin) & (bounds[:, 3] >= y0 - margin)
+            return np.flatnonzero(hit).tolist()
+
+        for n, i in enumerate(visible(fill_bounds)):
+            if n % _CANCEL_BATCH == 0:
+                check_cancelled(cancel)
+            poly, qcolor = fills[i]
+            painter.setBrush(qcolor)
+            painter.setPen(qcolor)
+            painter.drawPolygon(poly)
+        r, g, b, a = layer.line_rgba
+        line_color = QColor(r, g, b, a)
+        pen = QPen(line_color)
+        pen.setWidth(layer.line_width)
+        painter.setPen(pen)
+        painter.setBrush(QColor(0,0,0,0))
+        for n, i in enumerate(visible(line_bounds)):
+            if n % _CANCEL_BATCH == 0:
+                check_cancelled(cancel)
+            painter.drawPolyline(lines[i])
+
+    def preview_qimage(self, max_width, max_height, antialiasing=False, min_feature=0.5, progress_callback=None, cancel: CancelToken = None,
+                       parallel=True, max_workers=None):
+        """
+        プレビュー用に、max_width x max_height に収まる大きさで直接描いた画像を返す。
+        縮小した painter で描き、縮小後に min_feature ピクセルより小さくなる塗りと線分は省く。
+        塗りは縮小後の1ピクセル程度で単純化し、線は折れ線にまとめずに線分のまま描く。
+        parallel は to_qimage と同じく、レイヤーごとにスレッドプールで描いてから重ねる
+        """
+        from PyQt6.QtGui import QImage
+        from PyQt6.QtCore import Qt
+        w, h = self.width(), self.height()
+        scale = min(max_width / w, max_height / h, 1.0)
+        image = QImage(max(1, round(w * scale)), max(1, round(h * scale)), QImage.Format.Format_ARGB32_Premultiplied)
+        image.fill(Qt.GlobalColor.transparent)
+        layers = [layer for layer in self.layers if layer.visible]
+        self._compose_layers(image, layers, lambda painter, layer: self._paint_preview_layer(painter, layer, scale, antialiasing, min_feature / scale, cancel),
+                             progress_callback, parallel, max_workers)
+        if progress_callback: progress_callback(1.0)
+        return image
+
+    @staticmethod
+    def _paint_preview_layer(painter, layer: Layer, scale, antialiasing, min_extent, cancel: CancelToken = None):
+        # プレビュー用に1つのレイヤーを scale 倍で描く
+        from PyQt6.QtGui import QPainter, QColor, QPen
+        check_cancelled(cancel)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, antialiasing)
+        painter.scale(scale, scale)
+        fills, lines = layer.derived(('preview', min_extent), (layer.fill_key(), layer.line_key()),
+                                     lambda: Canvas._build_preview_primitives(layer, min_extent, cancel))
+        # 塗り領域
+        current = None
+        for n, (poly, qcolor) in enumerate(fills):
+            if n % _CANCEL_BATCH == 0:
+                check_cancelled(cancel)
+            if qcolor is not current:
+                current = qcolor
                 painter.setBrush(qcolor)
                 painter.setPen(qcolor)
-                poly = QPolygonF([QtCore.QPointF(int(x), int(y)) for x, y in coords])
-                painter.drawPolygon(poly)
-            # 線描画（レイヤーごとの色と太さ）
+            painter.drawPolygon(poly)
+        # 線（線分のまま）
+        if lines:
             r, g, b, a = layer.line_rgba
-            line_color = QColor(r, g, b, a)
-            pen = QPen(line_color)
+            pen = QPen(QColor(r, g, b, a))
             pen.setWidth(layer.line_width)
             painter.setPen(pen)
-            painter.setBrush(Qt.BrushStyle.NoBrush)
-            for line in layer.lines:
-                painter.drawLine(int(line.coords[0][0]), int(line.coords[0][1]), 
-                                 int(line.coords[1][0]), int(line.coords[1][1]))
-
-    def get_region_boundary_edges(self, target_polygons: List[Polygon]) -> List[LineString]:
-        """
-        領域に接する線のみを取得。なお、領域は線の共有エッジしか持たず、重なることはない前提。
-        そのため、各領域の辺を取得するだけで良い。重複は除外される。
-        """
-        from shapely.geometry import LineString
-        edges: List[LineString] = []
-        for region in target_polygons:
-            coords = list(region.exterior.coords)
-            for i in range(len(coords) - 1):
-                if any(map(lambda e: self._coords_equal(e.coords[0], coords[i]) and self._coords_equal(e.coords[1], coords[i + 1]), edges)):
-                    continue
-                edge = LineString([coords[i], coords[i + 1]])
-                edges.append(edge)
+            painter.drawLines(lines)
+        painter.resetTransform()
 
-        return edges
-        
-    def _coords_equal(self, c1, c2, tol=1e-6):
-        import math
-        return math.isclose(c1[0], c2[0], abs_tol=tol) and math.isclose(c1[1], c2[1], abs_tol=tol)
-
-    def _merge_connected_lines(self, lines):
-        """
-        Merge connected LineStrings into polylines (list of points).
-        Returns a list of polylines, each as a list of (x, y) tuples.
-        Uses math.isclose for coordinate equality.
-        """
-        from shapely.geometry import LineString
-        unused = [list(line.coords) for line in lines if isinstance(line, LineString)]
-        polylines = []
-        while unused:
-            poly = unused.pop(0)
-            changed = True
-            while changed:
-                changed = False
-                for i, other in enumerate(unused):
-                    if self._coords_equal(poly[-1], other[0]):
-                        poly += other[1:]
-                        unused.pop(i)
-                        changed = True
-                        break
-                    elif self._coords_equal(poly[0], other[-1]):
-                        poly = other[:-1] + poly
-                        unused.pop(i)
-                        changed = True
-                        break
-                    elif self._coords_equal(poly[0], other[0]):
-                        poly = other[::-1] + poly
-                        unused.pop(i)
-                        changed = True
-                        break
-                    elif self._coords_equal(poly[-1], other[-1]):
-                        poly += other[-2::-1]
-                        unused.pop(i)
-                        changed = True
-                        break
-            polylines.append(poly)
-        return polylines
-
-    def get_outside_edges(self, colored_polys):
-        """
-        Return edges that are outside colored regions (not shared between regions).
-        """
-        from shapely.geometry import LineString
-
-        # Collect all polygon edges
-        all_edges = []
-        for region in colored_polys:
-            coords = list(region.exterior.coords)
-            for i in range(len(coords) - 1):  # 最後の点は最初の点と同じ（閉じている）
-                edge = LineString([coords[i], coords[i+1]])
-                all_edges.append(edge)
-
-        # Get shared edges
-        shared_edges = []
-        for i, poly1 in enumerate(colored_polys):
-            for j, poly2 in enumerate(colored_polys):
-                if i >= j:
-                    continue
-                inter = poly1.boundary.intersection(poly2.boundary)
-                if inter.is_empty:
-                    continue
-                if isinstance(inter, LineString):
-                    shared_edges.append(inter)
-                elif inter.geom_type == 'MultiLineString':
-                    shared_edges.extend(inter.geoms)
-
-        # Normalize edge key: unordered pair of rounded coords
-        def edge_key(edge):
-            coords = list(edge.coords)
-            if len(coords) != 2:
-                return None
-            a, b = coords
-            a = tuple(round(c, 6) for c in a)
-            b = tuple(round(c, 6) for c in b)
-            return tuple(sorted([a, b]))
-
-        shared_keys = set(edge_key(e) for e in shared_edges if edge_key(e))
-        outside_edges = [e for e in all_edges if edge_key(e) not in shared_keys]
-        return outside_edges
-
-    def to_svg(self, path):
-        w, h = self.width(), self.height()
-        svg = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 {w} {h}">']
-        for idx, layer in enumerate(self.layers):
-            if not layer.visible:
-                continue
-            mode = getattr(layer, 'save_mode', 0)
-            # 塗り領域
-            if mode in (0, 1, 3, 4):  # 通常, 接する線のみ, 塗りつぶしだけ, 外側の線のみ
-                for region, rgba in layer.colored_regions:
-                    coords = list(region.exterior.coords)
-                    r, g, b, a = rgba
-                    fill = f'rgba({r},{g},{b},{a/255:.2f})' if a < 255 else f'rgb({r},{g},{b})'
-                    points = ' '.join(f'{int(x)},{int(y)}' for x, y in coords)
-                    svg.append(f'<polygon points="{points}" style="fill:{fill};stroke:{fill};stroke-width:1" />')
-            # 線
-            r, g, b, a = layer.line_rgba
-            stroke = f'rgba({r},{g},{b},{a/255:.2f})' if a < 255 else f'rgb({r},{g},{b})'
-            sw = layer.line_width
-            if mode == 0:
-                merged_lines = unary_union(layer.lines)
-                if hasattr(merged_lines, 'geoms'):
-                    polylines = self._merge_connected_lines(merged_lines.geoms)
-                    for poly in polylines:
-                        if len(poly) >= 2:
-                            svg.append(f'<polyline points="{" ".join(f"{int(x)},{int(y)}" for x, y in poly)}" style="stroke:{stroke};stroke-width:{sw};fill:none" />')
-                elif isinstance(merged_lines, LineString):
-                    coords = list(merged_lines.coords)
-                    if len(coords) >= 2:
-                        svg.append(f'<polyline points="{" ".join(f"{int(x)},{int(y)}" for x, y in coords)}" style="stroke:{stroke};stroke-width:{sw};fill:none" />')
-            elif mode in (1, 2):
-                colored_polys = [region for region, _ in layer.colored_regions]
-                shared_edges = self.get_region_boundary_edges(colored_polys)
-                merged_lines = unary_union(shared_edges)
-                if hasattr(merged_lines, 'geoms'):
-                    polylines = self._merge_connected_lines(merged_lines.geoms)
-                    for poly in polylines:
-                        if len(poly) >= 2:
-                            svg.append(f'<polyline points="{" ".join(f"{int(x)},{int(y)}" for x, y in poly)}" style="stroke:{stroke};stroke-width:{sw};fill:none" />')
-                elif isinstance(merged_lines, LineString):
-                    coords = list(merged_lines.coords)
-                    if len(coords) >= 2:
-                        svg.append(f'<polyline points="{" ".join(f"{int(x)},{int(y)}" for x, y in coords)}" style="stroke:{stroke};stroke-width:{sw};fill:none" />')
-            elif mode == 3:
-                # 塗りつぶしだけの場合は線は描画しない
-                continue
-            elif mode == 4 or mode == 5:
-                colored_polys = [region for region, _ in layer.colored_regions]
-                outside_edges = self.get_outside_edges(colored_polys)
-                merged_lines = unary_union(outside_edges)
-                if hasattr(merged_lines, 'geoms'):
-                    polylines = self._merge_connected_lines(merged_lines.geoms)
-                    for poly in polylines:
-                        if len(poly) >= 2:
-                            svg.append(f'<polyline points="{" ".join(f"{int(x)},{int(y)}" for x, y in poly)}" style="stroke:{stroke};stroke-width:{sw};fill:none" />')
-                elif isinstance(merged_lines, LineString):
-                    coords = list(merged_lines.coords)
-                    if len(coords) >= 2:
-                        svg.append(f'<polyline points="{" ".join(f"{int(x)},{int(y)}" for x, y in coords)}" style="stroke:{stroke};stroke-width:{sw};fill:none" />')
-        svg.append('</svg>')
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write('\n'.join(svg))
-
-    def to_qimage(self, antialiasing=False, progress_callback=None):
-        from PyQt6.QtGui import QImage, QPainter, QColor, QPen, QPolygonF
-        from PyQt6.QtCore import QPointF
+    @staticmethod
+    def _build_preview_primitives(layer: Layer, min_extent, cancel: CancelToken = None):
+        """
+        プレビュー用に、min_extent より小さい塗りと線分を省いて単純化した ([(QPolygonF, QColor)], [QLineF]) を作る
+        """
+        from PyQt6.QtGui import QColor, QPolygonF
+        from PyQt6.QtCore import QLineF, QPointF
+        fills = []
+        if getattr(layer, 'save_mode', 0) in (0, 1, 3, 4):  # 通常, 接する線のみ, 塗りつぶしだけ, 外側の線のみ
+            colored = layer.colored_regions()
+            if colored:
+                polygons = np.array([region for region, _ in colored], dtype=object)
+                bounds = shapely.bounds(polygons)
+                keep = np.flatnonzero(np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]) >= min_extent)
+                simplified = shapely.simplify(polygons[keep], min_extent)
+                qcolor, current = None, None
+                for n, (i, polygon) in enumerate(zip(keep.tolist(), simplified)):
+                    if n % _CANCEL_BATCH == 0:
+                        check_cancelled(cancel)
+                    if colored[i][1] != current:
+                        # 同じ色が続くあいだは同じ QColor を使う（描くときに色の切り替えを省ける）
+                        current = colored[i][1]
+                        qcolor = QColor(*current)
+                    fills.append((QPolygonF([QPointF(x, y) for x, y in shapely.get_coordinates(polygon).tolist()]), qcolor))
+        segments = layer.export_segments()
+        lines = []
+        if len(segments):
+            d = segments[:, 1] - segments[:, 0]
+            segments = segments[np.hypot(d[:, 0], d[:, 1]) >= min_extent]
+            lines = [QLineF(x0, y0, x1, y1) for (x0, y0), (x1, y1) in segments.tolist()]
+        return fills, lines
+
+    def export_png(self, path, scale=1, antialiasing=False, progress_callback=None, strip_bytes=32 << 20, cancel: CancelToken = None):
+        """
+        キャンバスを scale 倍の PNG として横長の帯ごとに描いて書き出す。
+        帯にかかる図形だけを描き、描いた行はすぐに PNG に流すので、使うメモリは帯1本ぶんで済む。
+        一時ファイルに書いてから差し替えるので、cancel が取り消されたり途中で失敗したりしても元のファイルは残る
+        （取り消されたときは RenderCancelled を投げる）
+        """
+        from PyQt6.QtGui import QImage, QPainter
+        from PyQt6.QtCore import Qt
+        from png_writer import PngWriter
+        from project_io import atomic_replace
         w, h = self.width(), self.height()
-        image = QImage(w, h, QImage.Format.Format_ARGB32)
-        painter = QPainter(image)
-        if antialiasing:
-            painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-        for idx, layer in enumerate(self.layers):
-            if progress_callback:
-                progress_callback(idx / len(self.layers))
-            if not layer.visible:
-                continue
-            mode = getattr(layer, 'save_mode', 0)
-            # 塗り領域
-            if mode in (0, 1, 3, 4):  # 通常, 接する線のみ, 塗りつぶしだけ, 外側の線のみ
-                for region, rgba in layer.colored_regions:
-                    coords = region.exterior.coords
-                    rr, gg, bb, aa = rgba
-                    qcolor = QColor(rr, gg, bb, aa)
-                    painter.setBrush(qcolor)
-                    painter.setPen(qcolor)
-                    poly = QPolygonF([QPointF(x, y) for x, y in coords])
-                    painter.drawPolygon(poly)
-            # 線
-            r, g, b, a = layer.line_rgba
-            line_color = QColor(r, g, b, a)
-            pen = QPen(line_color)
-            pen.setWidth(layer.line_width)
-            painter.setPen(pen)
-            painter.setBrush(QColor(0,0,0,0))
-            if mode == 0:
-                for lines in layer.lines:
-                    coords = list(lines.coords)
-                    if len(coords) == 2:
-                        x1, y1 = coords[0]
-                        x2, y2 = coords[1]
-                        painter.drawLine(int(x1), int(y1), int(x2), int(y2))
-            elif mode in (1, 2):
-                colored_polys = [region for region, _ in layer.colored_regions]
-                shared_edges = self.get_region_boundary_edges(colored_polys)
-                from shapely.geometry import LineString
-                for edge in shared_edges:
-                    if isinstance(edge, LineString):
-                        coords = list(edge.coords)
-                        if len(coords) == 2:
-                            x1, y1 = coords[0]
-                            x2, y2 = coords[1]
-                            painter.drawLine(int(x1), int(y1), int(x2), int(y2))
-                    elif hasattr(edge, 'geoms'):
-                        for geom in edge.geoms:
-                            coords = list(geom.coords)
-                            if len(coords) == 2:
-                                x1, y1 = coords[0]
-                                x2, y2 = coords[1]
-                                painter.drawLine(int(x1), int(y1), int(x2), int(y2))
-            elif mode == 3:
-                # 塗りつぶしだけの場合は線は描画しない
-                continue
-            elif mode == 4 or mode == 5:
-                colored_polys = [region for region, _ in layer.colored_regions]
-                outside_edges = self.get_outside_edges(colored_polys)
-                from shapely.geometry import LineString
-                for edge in outside_edges:
-                    if isinstance(edge, LineString):
-                        coords = list(edge.coords)
-                        if len(coords) == 2:
-                            x1, y1 = coords[0]
-                            x2, y2 = coords[1]
-                            painter.drawLine(int(x1), int(y1), int(x2), int(y2))
-                    elif hasattr(edge, 'geoms'):
-                        for geom in edge.geoms:
-                            coords = list(geom.coords)
-                            if len(coords) == 2:
-                                x1, y1 = coords[0]
-                                x2, y2 = coords[1]
-                                painter.drawLine(int(x1), int(y1), int(x2), int(y2))
-        painter.end()
-        if progress_callback: progress_callback(1.0)
-        return image
+        out_w, out_h = max(1, round(w * scale)), max(1, round(h * scale))
+        strip_h = max(1, min(out_h, strip_bytes // (out_w * 4)))
+        layers = [layer for layer in self.layers if layer.visible]
+        primitives = []
+        for layer in layers:
+            check_cancelled(cancel)
+            primitives.append(self._layer_primitives(layer))
+        strip = QImage(out_w, strip_h, QImage.Format.Format_ARGB32)
+        with atomic_replace(path) as tmp:
+            with PngWriter(tmp, out_w, out_h) as png:
+                for y0 in range(0, out_h, strip_h):
+                    rows = min(strip_h, out_h - y0)
+                    strip.fill(Qt.GlobalColor.transparent)
+                    painter = QPainter(strip)
+                    painter.translate(0, -y0)
+                    painter.scale(scale, scale)
+                    rect = (0, y0 / scale, w, (y0 + rows) / scale)
+                    try:
+                        for layer, prims in zip(layers, primitives):
+                            self._paint_layer(painter, layer, antialiasing, prims, rect, cancel)
+                    finally:
+                        painter.end()
+                    rgba = strip.convertToFormat(QImage.Format.Format_RGBA8888)
+                    bits = rgba.constBits()
+                    bits.setsize(rgba.sizeInBytes())
+                    data = np.frombuffer(bits, dtype=np.uint8).reshape(strip_h, rgba.bytesPerLine())
+                    png.write_rows(data[:rows, :out_w * 4].reshape(rows, out_w, 4))
+                    if progress_callback:
+                        progress_callback((y0 + rows) / out_h)
+
+    def release_idle_layers(self, idle_seconds):
+        """
+        アクティブでないレイヤーのうち、idle_seconds 秒以上領域を使っていないものの領域を手放す
+        """
+        now = time.monotonic()
+        for i, layer in enumerate(self.layers):
+            if i != self.active_layer and layer.has_geometry and now - layer.last_used >= idle_seconds:
+                layer.release_geometry()
+
+    def project(self) -> Project:
+        """
+        いまのレイヤーをそのまま持つ Project を返す
+        """
+        return Project(self.width(), self.height(), self.grid, self.layers)
+
+    def snapshot(self) -> Project:
+        """
+        いまの状態を写し取った Project を返す（別スレッドで保存しているあいだも編集を続けられる）
+        """
+        return Project(self.width(), self.height(), self.grid, [layer.snapshot() for layer in self.layers])
+
+    def set_project(self, project: Project):
+        """
+        読み込んだ Project のレイヤーに置き換える
+        """
+        # レイヤーが空でないことを確認
+        if not project.layers:
+            raise ValueError("レイヤーが存在しません。")
+        self.grid = project.grid
+        self.layers = project.layers
+        self.history.clear()
+        # アクティブレイヤーのインデックスを設定（最初のレイヤーをアクティブにする）
+        self.active_layer = 0
 
     def to_json(self):
         """
         レイヤー情報をJSONシリアライズ可能なdictで返す
         """
-        return {
-            'width': self.width(),
-            'height': self.height(),
-            'layers': [layer.to_json() for layer in self.layers]
-        }
+        return self.project().to_json()
 
     def reset_from_json(self, data):
         """
         JSONからキャンバス情報を復元する
         """
-        self.layers = []
-        for layer_data in data.get('layers', []):
-            layer = Layer.from_json(data['width'], data['height'], layer_data)
-            self.layers.append(layer)
-        
-        # アクティブレイヤーのインデックスを設定（最初のレイヤーをアクティブにする）
-        self.active_layer = 0 if self.layers else -1
+        self.set_project(Project.from_json(data))
 
-        # レイヤーが空でないことを確認
-        if not self.layers:
-            raise ValueError("レイヤーが存在しません。")
+    def to_binary(self, path):
+        """
+        キャンバス情報をバイナリ形式（project_io）で書き出す
+        """
+        self.project().write_binary(path)
+
+    def reset_from_binary(self, path):
+        """
+        バイナリ形式（project_io）のファイルからキャンバス情報を復元する
+        """
+        self.set_project(Project.from_binary(path))
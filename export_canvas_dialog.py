@@ -2,25 +2,42 @@ from typing import Callable
 from PyQt6.QtCore import QThread, pyqtSignal, QObject
 from PyQt6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QLineEdit, QFileDialog, QGraphicsView, QGraphicsScene, QProgressBar
 from PyQt6.QtGui import QPixmap, QImage
+from cancellation import CancelToken, RenderCancelled
 
 class ExportCanvasDialog(QDialog):
+    COARSE_FEATURE = 3.0  # 粗いプレビューで省く図形の大きさ（ピクセル）
+    FINE_FEATURE = 0.5  # 仕上げのプレビューで省く図形の大きさ（ピクセル）
+
     class PreviewWorker(QObject):
+        coarseReady = pyqtSignal(object)
         finished = pyqtSignal(object)
+        stopped = pyqtSignal()  # 描き終えたか取り消されたとき
         progressChanged = pyqtSignal(float)  # 0.0〜1.0
-        def __init__(self, create_preview_image, antialiasing):
+        def __init__(self, create_preview_image, antialiasing, size, cancel: CancelToken):
             super().__init__()
             self.create_preview_image = create_preview_image
             self.antialiasing = antialiasing
+            self.size = size
+            self.cancel = cancel
         def run(self):
-            def progress_callback(value):
-                self.progressChanged.emit(value)
-            qimage = self.create_preview_image(self.antialiasing, progress_callback)
-            self.finished.emit(qimage)
+            width, height = self.size
+            try:
+                # まず小さい図形を省いた粗い画像を出し、そのあと細かく描き直す
+                coarse = self.create_preview_image(False, lambda value: self.progressChanged.emit(value * 0.3), width, height, ExportCanvasDialog.COARSE_FEATURE, self.cancel)
+                self.cancel.check()
+                self.coarseReady.emit(coarse)
+                qimage = self.create_preview_image(self.antialiasing, lambda value: self.progressChanged.emit(0.3 + value * 0.7), width, height, ExportCanvasDialog.FINE_FEATURE, self.cancel)
+                self.cancel.check()
+                self.finished.emit(qimage)
+            except RenderCancelled:
+                pass
+            finally:
+                self.stopped.emit()
 
-    def __init__(self, parent=None, create_preview_image: Callable[[bool, Callable[[float], None]], QImage]=lambda antialiasing, prog_callback: QImage()):
+    def __init__(self, parent=None, create_preview_image: Callable[[bool, Callable[[float], None], int, int, float, CancelToken], QImage]=lambda antialiasing, prog_callback, width, height, min_feature, cancel: QImage()):
         super().__init__(parent)
         self.setWindowTitle("キャンバス保存")
-        self.setFixedSize(400, 320)
+        self.setFixedSize(400, 350)
         layout = QVBoxLayout()
         hlayout_file = QHBoxLayout()
         self.file_edit = QLineEdit("canvas.svg")
@@ -34,6 +51,15 @@ class ExportCanvasDialog(QDialog):
         self.antialias_checkbox = QCheckBox("アンチエイリアシング")
         self.antialias_checkbox.setChecked(True)
         layout.addWidget(self.antialias_checkbox)
+        # 拡大率（PNG 保存時）
+        from PyQt6.QtWidgets import QComboBox
+        hlayout_scale = QHBoxLayout()
+        self.scale_combo = QComboBox()
+        for scale in (1, 2, 4):
+            self.scale_combo.addItem(f"{scale}x", scale)
+        hlayout_scale.addWidget(QLabel("拡大率 (PNG):"))
+        hlayout_scale.addWidget(self.scale_combo)
+        layout.addLayout(hlayout_scale)
         # プレビュー
         self.preview_label = QLabel("プレビュー:")
         layout.addWidget(self.preview_label)
@@ -58,23 +84,54 @@ class ExportCanvasDialog(QDialog):
         file_btn.clicked.connect(self.open_file_dialog)
         self.create_preview_image = create_preview_image
         self.preview_thread = None
+        self.preview_worker = None
+        self.preview_cancel = None
+        self.pending_preview = None  # 描画中に来た最新のプレビュー要求
         self.set_preview_image_async(create_preview_image, self.antialias_checkbox.isChecked())
         self.antialias_checkbox.stateChanged.connect(lambda: self.set_preview_image_async(self.create_preview_image, self.antialias_checkbox.isChecked()))
 
     def set_preview_image_async(self, create_preview_image, antialiasing):
         # 非同期でプレビュー画像を生成
-        if self.preview_thread:
-            self.preview_thread.quit()
-            self.preview_thread.wait()
-        self.preview_worker = self.PreviewWorker(create_preview_image, antialiasing)
+        # 描画中なら取り消しだけ伝え、終わりしだい最新の要求だけを描く（GUI スレッドは待たない）
+        self.pending_preview = (create_preview_image, antialiasing)
+        if self.preview_thread is not None:
+            self.preview_cancel.cancel()
+            return
+        self.start_pending_preview()
+
+    def start_pending_preview(self):
+        create_preview_image, antialiasing = self.pending_preview
+        self.pending_preview = None
+        self.preview_cancel = CancelToken()
+        self.preview_worker = self.PreviewWorker(create_preview_image, antialiasing, self.preview_size(), self.preview_cancel)
         self.preview_thread = QThread()
         self.preview_worker.moveToThread(self.preview_thread)
         self.preview_thread.started.connect(self.preview_worker.run)
+        self.preview_worker.coarseReady.connect(self.show_preview_image)
         self.preview_worker.finished.connect(self.set_preview_image)
-        self.preview_worker.finished.connect(self.preview_thread.quit)
+        self.preview_worker.stopped.connect(self.preview_thread.quit)
         self.preview_worker.progressChanged.connect(self.on_preview_progress)
+        self.preview_thread.finished.connect(self.on_preview_thread_finished)
         self.preview_thread.start()
 
+    def on_preview_thread_finished(self):
+        # finished が届いてもスレッドはまだ後始末の途中のことがあるので、止まりきるのを待ってから手放す
+        self.preview_thread.wait()
+        self.preview_thread.deleteLater()
+        self.preview_thread = None
+        self.preview_worker = None
+        if self.pending_preview is not None:
+            self.start_pending_preview()
+
+    def done(self, result):
+        # 閉じるときは描画を取り消し、スレッドが止まるのを待つ（取り消しはすぐ効く）
+        self.pending_preview = None
+        if self.preview_thread is not None:
+            self.preview_cancel.cancel()
+            self.preview_thread.quit()
+            self.preview_thread.wait()
+        super().done(result)
+
     def update_preview_image(self):
         """
         Update the preview image according to the anti-aliasing checkbox state.
@@ -84,7 +141,7 @@ class ExportCanvasDialog(QDialog):
     def on_preview_progress(self, value):
         self.progress_bar.setValue(int(value * 100))
     def open_file_dialog(self):
-        path, _ = QFileDialog.getSaveFileName(self, "保存先", self.file_edit.text(), "PNG Files (*.png);;SVG Files (*.svg);;All Files (*)")
+        path, _ = QFileDialog.getSaveFileName(self, "保存先", self.file_edit.text(), "PNG Files (*.png);;SVG Files (*.svg);;SVGZ Files (*.svgz);;All Files (*)")
         if path:
             self.file_edit.setText(path)
     def get_params(self):
@@ -95,10 +152,28 @@ class ExportCanvasDialog(QDialog):
         Returns True if anti-aliasing is enabled.
         """
         return self.antialias_checkbox.isChecked()
+
+    def get_scale(self):
+        """
+        Returns the selected export scale factor.
+        """
+        return self.scale_combo.currentData()
     
-    def set_preview_image(self, qimage: QImage):
+    def preview_size(self):
+        """
+        Returns the preview image size (in device pixels) that fits the preview view.
+        """
+        ratio = self.devicePixelRatioF()
+        width = self.width() - 40
+        height = self.preview_view.height()
+        return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+    def show_preview_image(self, qimage: QImage):
         pixmap = QPixmap.fromImage(qimage)
         self.preview_scene.clear()
         self.preview_scene.addPixmap(pixmap)
         self.preview_view.fitInView(self.preview_scene.itemsBoundingRect())
+
+    def set_preview_image(self, qimage: QImage):
+        self.show_preview_image(qimage)
         self.progress_bar.setValue(100)
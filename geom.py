@@ -1,44 +1,650 @@
 import math
-import random
 from typing import List
-from shapely.geometry import LineString, Polygon
-from shapely.ops import polygonize, unary_union
+import numpy as np
+import shapely
+from shapely.geometry import LineString, Point, Polygon
 
-def generate_lines(width, height, count=20) -> List[LineString]:
-    lines = []
+# 交差判定をまとめて行うときの1チャンクあたりの組数の目安
+_PAIR_CHUNK = 1 << 22
+# 線分上の位置（0〜1）を端点とみなす許容誤差
+_PARAM_EPS = 1e-9
+# 座標を丸める格子の細かさ（1ピクセルあたりの分割数）。2のべき乗なら丸めた座標は float で正確に表せる
+DEFAULT_GRID = 1024
+
+def snap(coords: np.ndarray, grid) -> np.ndarray:
+    """
+    座標を 1/grid 刻みの格子に丸める。grid が None なら何もしない
+    """
+    if not grid:
+        return coords
+    return np.round(np.asarray(coords, dtype=float) * grid) / grid
+
+def grid_keys(coords: np.ndarray, grid) -> np.ndarray:
+    """
+    格子上の座標を整数の格子番号に変換する（辞書のキーや重複除去に使う）
+    """
+    return np.round(np.asarray(coords, dtype=float) * grid).astype(np.int64)
+
+def ring_key(polygon: Polygon, grid) -> bytes:
+    """
+    領域の外周を、始点や向きによらない格子番号の列（bytes）にする
+    """
+    keys = grid_keys(shapely.get_coordinates(polygon.exterior)[:-1], grid)
+    if len(keys) == 0:
+        return b''
+    # 最小の頂点から始め、隣の頂点が小さい方の向きにそろえる
+    start = np.lexsort((keys[:, 1], keys[:, 0]))[0]
+    keys = np.roll(keys, -start, axis=0)
+    if tuple(keys[-1]) < tuple(keys[1 % len(keys)]):
+        keys = np.concatenate([keys[:1], keys[:0:-1]])
+    return keys.tobytes()
+
+def new_seed() -> int:
+    """
+    線の生成に使う新しいシード値を返す
+    """
+    return int(np.random.SeedSequence().entropy % (1 << 63))
+
+def generate_line_coords(width, height, count=20, seed=None) -> np.ndarray:
+    """
+    ランダムな線の端点を (count, 2, 2) の配列としてまとめて生成する。seed が同じなら同じ線になる
+    """
+    rng = np.random.default_rng(seed)
     diag = math.hypot(width, height)
-    for _ in range(count):
-        angle = random.uniform(0, 2 * math.pi)
-        cx = random.uniform(0, width)
-        cy = random.uniform(0, height)
-        length = diag + random.uniform(20, 100)
-        dx = math.cos(angle) * length
-        dy = math.sin(angle) * length
-        x1 = cx - dx
-        y1 = cy - dy
-        x2 = cx + dx
-        y2 = cy + dy
-        lines.append(LineString([(x1, y1), (x2, y2)]))
-
-    return lines
-
-def create_regions(w: float, h:float, lines: List[LineString]) -> List[Polygon]:
-    all_lines = lines + [
-        LineString([(0, 0), (w, 0)]),
-        LineString([(w, 0), (w, h)]),
-        LineString([(w, h), (0, h)]),
-        LineString([(0, h), (0, 0)])
-    ]
-    merged_lines = unary_union(all_lines)
-    polygons = polygonize(merged_lines)
-    regions = []
-    for poly in polygons:
-        if isinstance(poly, Polygon):
-            regions.append(poly)
-    return regions
-
-def regions_in(regions: List[Polygon], partial_regions: List[Polygon], tolerance: float = 1e-8) -> bool:
-    for pr in partial_regions:
-        if not any(pr.equals_exact(r, tolerance) for r in regions):
-            return False
-    return True
+    angle = rng.uniform(0, 2 * math.pi, count)
+    cx = rng.uniform(0, width, count)
+    cy = rng.uniform(0, height, count)
+    length = diag + rng.uniform(20, 100, count)
+    d = np.stack([np.cos(angle) * length, np.sin(angle) * length], axis=1)
+    c = np.stack([cx, cy], axis=1)
+    return np.stack([c - d, c + d], axis=1)
+
+def generate_lines(width, height, count=20, seed=None, as_array=False) -> List[LineString]:
+    """
+    ランダムな線を生成する。as_array=True なら LineString を作らずに端点の配列を返す
+    """
+    coords = generate_line_coords(width, height, count, seed)
+    if as_array:
+        return coords
+    return list(shapely.linestrings(coords))
+
+def line_segments(lines) -> np.ndarray:
+    """
+    LineString のリスト（または (N, 2, 2) 配列）を線分の (M, 2, 2) 配列にする
+    """
+    if isinstance(lines, np.ndarray):
+        return lines.reshape(-1, 2, 2).astype(float)
+    if len(lines) == 0:
+        return np.empty((0, 2, 2))
+    coords, index = shapely.get_coordinates(np.asarray(lines, dtype=object), return_index=True)
+    # 同じ線に属する連続した2点を線分にする
+    same = index[1:] == index[:-1]
+    return np.stack([coords[:-1][same], coords[1:][same]], axis=1)
+
+def clip_segments(segments: np.ndarray, w: float, h: float, grid=None) -> np.ndarray:
+    """
+    線分を矩形 [0, w] x [0, h] で切り取る（Liang-Barsky）。枠上の端点は枠の座標にそろえ、grid があれば格子に丸める
+    """
+    p0 = segments[:, 0]
+    d = segments[:, 1] - p0
+    t0 = np.zeros(len(segments))
+    t1 = np.ones(len(segments))
+    keep = np.ones(len(segments), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-d[:, 0], p0[:, 0]), (d[:, 0], w - p0[:, 0]),
+                     (-d[:, 1], p0[:, 1]), (d[:, 1], h - p0[:, 1])):
+            r = q / p
+            parallel = p == 0
+            keep &= ~(parallel & (q < 0))
+            entering = p < 0
+            leaving = p > 0
+            t0 = np.where(entering, np.maximum(t0, r), t0)
+            t1 = np.where(leaving, np.minimum(t1, r), t1)
+    keep &= t1 - t0 > 1e-12
+    a = p0 + d * t0[:, None]
+    b = p0 + d * t1[:, None]
+    clipped = np.stack([a, b], axis=1)[keep]
+    # 枠の上に乗った端点は正確に枠の座標にする（枠の辺と確実につながるように）
+    eps = 1e-9 * max(w, h, 1.0)
+    x = clipped[..., 0]
+    y = clipped[..., 1]
+    x[np.abs(x) <= eps] = 0.0
+    x[np.abs(x - w) <= eps] = w
+    y[np.abs(y) <= eps] = 0.0
+    y[np.abs(y - h) <= eps] = h
+    clipped = snap(clipped, grid)
+    return clipped[(clipped[:, 0] != clipped[:, 1]).any(axis=1)]
+
+def _pair_params(ai, ri, aj, rj):
+    # 線分 ai + t*ri と aj + u*rj の交点の位置 t, u（denom == 0 なら平行）
+    denom = ri[:, 0] * rj[:, 1] - ri[:, 1] * rj[:, 0]
+    qp = aj - ai
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (qp[:, 0] * rj[:, 1] - qp[:, 1] * rj[:, 0]) / denom
+        u = (qp[:, 0] * ri[:, 1] - qp[:, 1] * ri[:, 0]) / denom
+    return denom, t, u
+
+def segment_crossings(segment: np.ndarray, others: np.ndarray, grid=None) -> np.ndarray:
+    """
+    線分 segment が others の各線分と交わる点を返す（どちらも格子に丸める前の線分を渡す）。
+    片方の端点がもう片方の途中に乗る（T字の）点も含める。
+    segment を others の後ろに足して node_segments したときと同じ計算をするので、座標も完全に一致する
+    """
+    if len(others) == 0:
+        return np.empty((0, 2))
+    ai = others[:, 0]
+    ri = others[:, 1] - ai
+    aj = np.repeat(segment[:1], len(others), axis=0)
+    rj = np.repeat((segment[1] - segment[0])[None, :], len(others), axis=0)
+    denom, t, u = _pair_params(ai, ri, aj, rj)
+    t_in = (t > _PARAM_EPS) & (t < 1 - _PARAM_EPS)
+    u_in = (u > _PARAM_EPS) & (u < 1 - _PARAM_EPS)
+    t_end = (np.abs(t) <= _PARAM_EPS) | (np.abs(t - 1) <= _PARAM_EPS)
+    u_end = (np.abs(u) <= _PARAM_EPS) | (np.abs(u - 1) <= _PARAM_EPS)
+    hit = (denom != 0) & ((t_in & (u_in | u_end)) | (t_end & u_in))
+    t, u, t_in, u_in = t[hit], u[hit], t_in[hit], u_in[hit]
+    pt = ai[hit] + ri[hit] * t[:, None]
+    # 端点に乗る交点は端点の座標そのものを使う
+    pt = np.where(u_in[:, None], pt, segment[(u > 0.5).astype(int)])
+    pt = np.where(t_in[:, None], pt, others[hit][np.arange(len(t)), (t > 0.5).astype(int)])
+    return snap(pt, grid)
+
+def node_segments(segments: np.ndarray, grid=None) -> np.ndarray:
+    """
+    線分同士の交点で線分を分割する。交点は組ごとに一度だけ計算するので、両側で座標が完全に一致する。
+    grid があれば交点を格子に丸める
+    """
+    n = len(segments)
+    a = segments[:, 0]
+    r = segments[:, 1] - a
+    seg_ids = [np.arange(n), np.arange(n)]
+    params = [np.zeros(n), np.ones(n)]
+    points = [segments[:, 0], segments[:, 1]]
+    rows = max(1, _PAIR_CHUNK // max(n, 1))
+    for start in range(0, n, rows):
+        i = np.arange(start, min(start + rows, n))
+        # 上三角 (i < j) の組だけを調べる
+        ii, jj = np.nonzero(np.arange(n)[None, :] > i[:, None])
+        ii = i[ii]
+        if len(ii) == 0:
+            continue
+        ri, rj = r[ii], r[jj]
+        denom, t, u = _pair_params(a[ii], ri, a[jj], rj)
+        # 片方の端点がもう片方の途中に乗る（T字の）場合も分割する
+        t_in = (t > _PARAM_EPS) & (t < 1 - _PARAM_EPS)
+        u_in = (u > _PARAM_EPS) & (u < 1 - _PARAM_EPS)
+        t_end = (np.abs(t) <= _PARAM_EPS) | (np.abs(t - 1) <= _PARAM_EPS)
+        u_end = (np.abs(u) <= _PARAM_EPS) | (np.abs(u - 1) <= _PARAM_EPS)
+        hit = (denom != 0) & ((t_in & (u_in | u_end)) | (t_end & u_in))
+        if not hit.any():
+            continue
+        ii, jj, t, u = ii[hit], jj[hit], t[hit], u[hit]
+        t_in, u_in = t_in[hit], u_in[hit]
+        pt = a[ii] + ri[hit] * t[:, None]
+        # 端点に乗る交点は端点の座標そのものを使う
+        pt = np.where(u_in[:, None], pt, segments[jj, (u > 0.5).astype(int)])
+        pt = np.where(t_in[:, None], pt, segments[ii, (t > 0.5).astype(int)])
+        seg_ids += [ii[t_in], jj[u_in]]
+        params += [t[t_in], u[u_in]]
+        points += [pt[t_in], pt[u_in]]
+    seg_ids = np.concatenate(seg_ids)
+    params = np.concatenate(params)
+    points = np.concatenate(points)
+    order = np.lexsort((params, seg_ids))
+    seg_ids = seg_ids[order]
+    points = points[order]
+    # 交点は丸める前の線分どうしで求めてから格子に丸める（丸めた線どうしを交わらせると、浅い角度の交点が大きくずれる）
+    points = snap(points, grid)
+    same = seg_ids[1:] == seg_ids[:-1]
+    noded = np.stack([points[:-1][same], points[1:][same]], axis=1)
+    # 丸めで重なった交点からできる長さ0の線分は捨てる
+    return noded[(noded[:, 0] != noded[:, 1]).any(axis=1)]
+
+def _frame_segments(w: float, h: float, clipped: np.ndarray) -> np.ndarray:
+    """
+    枠の4辺を、枠の上にある線分の端点で分割した線分の配列を返す
+    """
+    pts = clipped.reshape(-1, 2)
+    corners = np.array([(0.0, 0.0), (w, 0.0), (w, h), (0.0, h)])
+    edges = []
+    # (辺上の点の条件, 辺に沿った座標, 始点, 終点)
+    for on_side, axis, start, end in (
+        (pts[:, 1] == 0.0, 0, corners[0], corners[1]),
+        (pts[:, 0] == w, 1, corners[1], corners[2]),
+        (pts[:, 1] == h, 0, corners[2], corners[3]),
+        (pts[:, 0] == 0.0, 1, corners[3], corners[0]),
+    ):
+        side = np.unique(np.vstack([start, pts[on_side], end]), axis=0)
+        side = side[np.argsort(side[:, axis])]
+        edges.append(np.stack([side[:-1], side[1:]], axis=1))
+    return np.concatenate(edges)
+
+def polygonize_segments(segments: np.ndarray) -> List[Polygon]:
+    """
+    分割済みの線分の配列から領域を作る
+    """
+    if len(segments) == 0:
+        return []
+    merged = shapely.polygonize(shapely.linestrings(segments))
+    return [poly for poly in shapely.get_parts(merged) if isinstance(poly, Polygon)]
+
+def create_regions(w: float, h:float, lines: List[LineString], grid=None) -> List[Polygon]:
+    """
+    線と枠で区切られた領域を返す。線は枠で切り取ってから交点で分割し、一度だけ polygonize する。
+    grid があれば頂点はすべて 1/grid 刻みの格子に乗る
+    """
+    clipped = clip_segments(line_segments(lines), w, h)
+    noded = node_segments(clipped, grid)
+    edges = np.concatenate([noded, _frame_segments(w, h, snap(clipped, grid))])
+    if grid:
+        # 丸めで重なった辺があれば1本にまとめる
+        edges = _unique_segments(edges)
+    return canonical_order(polygonize_segments(edges))
+
+_CHECKSUM_SCALE = 16  # 並びのチェックサムで重心・面積を丸める細かさ
+
+def region_fingerprints(polygons):
+    """
+    領域ごとの (重心の (N, 2) 配列, 面積の (N,) 配列) を返す
+    """
+    if len(polygons) == 0:
+        return np.empty((0, 2)), np.empty(0)
+    polygons = np.asarray(polygons, dtype=object)
+    return shapely.get_coordinates(shapely.centroid(polygons)), shapely.area(polygons)
+
+def region_shapes(polygons) -> np.ndarray:
+    """
+    領域ごとの [重心 x, 重心 y, 面積, 周長] の (N, 4) 配列を返す。
+    領域そのものがなくても CentroidIndex.find_shapes で領域を探せるように、塗りと一緒に保存する
+    """
+    centroids, areas = region_fingerprints(polygons)
+    lengths = shapely.length(np.asarray(polygons, dtype=object)) if len(polygons) else np.empty(0)
+    return np.column_stack([centroids, areas, lengths]).reshape(-1, 4)
+
+def canonical_order(polygons: List[Polygon]) -> List[Polygon]:
+    """
+    領域を重心の y, x（同じなら面積）の順に並べ替える。
+    polygonize の出力順は GEOS の版などで変わりうるので、保存する領域インデックスはこの順に固定する
+    """
+    centroids, areas = region_fingerprints(polygons)
+    keys = np.round(np.column_stack([centroids, areas]) * _CHECKSUM_SCALE)
+    order = np.lexsort((keys[:, 2], keys[:, 0], keys[:, 1])) if len(polygons) else []
+    return [polygons[i] for i in order]
+
+def arrangement_checksum(polygons) -> str:
+    """
+    領域の並びのチェックサム。領域の数と、並び順どおりの重心・面積（1/16 単位に丸めたもの）から作る
+    """
+    import hashlib
+    centroids, areas = region_fingerprints(polygons)
+    keys = np.round(np.column_stack([centroids, areas]) * _CHECKSUM_SCALE).astype(np.int64)
+    digest = hashlib.blake2b(np.int64(len(keys)).tobytes(), digest_size=16)
+    digest.update(keys.tobytes())
+    return digest.hexdigest()
+
+class CentroidIndex:
+    """
+    重心を格子に振り分けた辞書で、重心と面積が近い領域を探す。
+    座標が少しずれた（古いファイルなどの）ポリゴンを、総当たりせずに領域インデックスへ対応づけるのに使う
+    """
+
+    def __init__(self, polygons, tolerance: float):
+        self.tolerance = tolerance
+        self.cell = max(tolerance * 4, 1e-6)
+        centroids, areas = region_fingerprints(polygons)
+        self.centroids, self.areas = centroids.tolist(), areas.tolist()
+        self.buckets = {}
+        for i, key in enumerate(np.floor(centroids / self.cell).astype(np.int64).tolist()):
+            self.buckets.setdefault(tuple(key), []).append(i)
+
+    def find(self, polygon: Polygon):
+        """
+        polygon と重心・面積が許容誤差内で一致する領域のインデックスを返す（最も近いもの）。なければ None
+        """
+        return self.find_many([polygon])[0]
+
+    def find_many(self, polygons) -> list:
+        """
+        find をまとめて行う（重心・面積・周長はまとめて計算する）
+        """
+        return self.find_shapes(region_shapes(polygons))
+
+    def find_shapes(self, shapes) -> list:
+        """
+        region_shapes の形 [重心 x, 重心 y, 面積, 周長] の並びから、それぞれと一致する領域のインデックス（なければ None）を返す
+        """
+        shapes = np.asarray(shapes, dtype=np.float64).reshape(-1, 4)
+        if len(shapes) == 0:
+            return []
+        centroids, areas = shapes[:, :2], shapes[:, 2]
+        # 頂点が tolerance だけずれると面積は最大で 周長 x tolerance ほど変わる
+        area_tolerances = shapes[:, 3] * self.tolerance + 1e-9
+        cells = np.floor(centroids / self.cell).astype(np.int64).tolist()
+        result = []
+        for (cx, cy), area, area_tolerance, (kx, ky) in zip(centroids.tolist(), areas.tolist(), area_tolerances.tolist(), cells):
+            best, best_distance = None, None
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for i in self.buckets.get((kx + dx, ky + dy), ()):
+                        distance = math.hypot(self.centroids[i][0] - cx, self.centroids[i][1] - cy)
+                        if distance <= self.tolerance and abs(self.areas[i] - area) <= area_tolerance:
+                            if best is None or distance < best_distance:
+                                best, best_distance = i, distance
+            result.append(best)
+        return result
+
+class EdgeTable:
+    """
+    領域分割の辺の表。重複のない辺ごとに、左右どちらの領域に接しているか（領域インデックス、外側は -1）を持つ
+    """
+
+    def __init__(self, segments: np.ndarray, left: np.ndarray, right: np.ndarray):
+        self.segments = segments
+        self.left = left
+        self.right = right
+
+    def _colored_sides(self, colored_ids):
+        # 末尾の要素は「領域外 (-1)」用で、常に塗られていない扱い
+        n = max(int(self.left.max(initial=-1)), int(self.right.max(initial=-1))) + 2
+        colored = np.zeros(n, dtype=bool)
+        ids = np.fromiter(colored_ids, dtype=np.int64)
+        colored[ids[ids < n - 1]] = True
+        return colored[self.left], colored[self.right]
+
+    def touching(self, colored_ids) -> np.ndarray:
+        """
+        塗られた領域に接する辺を返す
+        """
+        left, right = self._colored_sides(colored_ids)
+        return self.segments[left | right]
+
+    def outside(self, colored_ids) -> np.ndarray:
+        """
+        塗られた領域の外側の辺（片側だけが塗られている辺）を返す
+        """
+        left, right = self._colored_sides(colored_ids)
+        return self.segments[left ^ right]
+
+def build_edge_table(polygons: List[Polygon], grid=None) -> EdgeTable:
+    """
+    領域の外周から辺の表を作る。隣り合う領域は頂点を共有しているので、座標が完全に一致する辺を同じ辺とみなす。
+    grid があれば格子番号（整数）で辺を突き合わせる
+    """
+    if len(polygons) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return EdgeTable(np.empty((0, 2, 2)), empty, empty)
+    rings = shapely.get_exterior_ring(np.asarray(polygons, dtype=object))
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    same = index[1:] == index[:-1]
+    a, b, owner = coords[:-1][same], coords[1:][same], index[:-1][same]
+    # 反時計回りの外周なら、辺 a->b の左側が領域の内側
+    owner_on_left = shapely.is_ccw(rings)[owner]
+    swap = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1]))
+    canon = np.where(swap[:, None], np.concatenate([b, a], axis=1), np.concatenate([a, b], axis=1))
+    if grid:
+        unique, inverse = np.unique(grid_keys(canon, grid), axis=0, return_inverse=True)
+        unique = unique / grid
+    else:
+        unique, inverse = np.unique(canon, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    left = np.full(len(unique), -1, dtype=np.int64)
+    right = np.full(len(unique), -1, dtype=np.int64)
+    on_left = owner_on_left != swap
+    left[inverse[on_left]] = owner[on_left]
+    right[inverse[~on_left]] = owner[~on_left]
+    return EdgeTable(unique.reshape(-1, 2, 2), left, right)
+
+def ring_segments(polygons: List[Polygon]) -> np.ndarray:
+    """
+    領域の外周を辺に分解し、重複（隣り合う領域の共有辺）を除いた (M, 2, 2) 配列を返す
+    """
+    if len(polygons) == 0:
+        return np.empty((0, 2, 2))
+    rings = shapely.get_exterior_ring(np.asarray(polygons, dtype=object))
+    return _unique_segments(line_segments(list(rings)))
+
+def _unique_segments(segments: np.ndarray) -> np.ndarray:
+    # 向きをそろえてから重複を除く
+    a, b = segments[:, 0], segments[:, 1]
+    swap = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1]))
+    canon = np.where(swap[:, None, None], segments[:, ::-1], segments)
+    return np.unique(canon.reshape(-1, 4), axis=0).reshape(-1, 2, 2)
+
+def inner_segments(polygons: List[Polygon], segments: np.ndarray, grid=None) -> np.ndarray:
+    """
+    segments（枠で切り取った、丸める前の線分）を全体を作り直したときと同じ計算で交点で分割し、
+    polygons の内部にある部分を返す。polygonize は行き止まりの線を捨てるので、領域の辺には残っていない部分
+    """
+    if len(polygons) == 0 or len(segments) == 0:
+        return np.empty((0, 2, 2))
+    tree = shapely.STRtree(polygons)
+    # 領域にかかる線だけを、元の順のまま分割する（組ごとの交点の計算が全体のときと同じになる）。
+    # 丸める前の線は辺から少しずれているので、辺に沿う線も拾えるよう少し離れていても含める
+    tolerance = 2.0 / grid if grid else 1e-9
+    hit = np.unique(tree.query(shapely.linestrings(segments), predicate='dwithin', distance=tolerance)[0])
+    if len(hit) == 0:
+        return np.empty((0, 2, 2))
+    noded = node_segments(segments[hit], grid)
+    # 辺の上の部分は外周にすでにある
+    inside = np.unique(tree.query(shapely.points(noded.mean(axis=1)), predicate='within')[0])
+    return noded[inside].reshape(-1, 2, 2)
+
+def split_regions(polygons: List[Polygon], segment: np.ndarray, grid=None, crossings: np.ndarray = None,
+                  extra: np.ndarray = None) -> List[Polygon]:
+    """
+    線分で横切られる領域の集まりを、その線分で分割し直した領域を返す。
+    crossings（segment_crossings で求めた、線分と他の線との交点）を渡すと、交点を計算し直さずにその点で分割する。
+    格子に丸めた辺と交わらせると全体を作り直したときと丸め方がずれるため。
+    extra（inner_segments で求めた、領域の中の行き止まりの線）も辺に加える。新しい線につながると領域を区切ることがある
+    """
+    edges = ring_segments(polygons)
+    if extra is not None and len(extra):
+        edges = np.concatenate([edges, extra])
+    if crossings is None:
+        noded = node_segments(np.concatenate([edges, segment.reshape(1, 2, 2)]), grid)
+    else:
+        points = np.concatenate([crossings.reshape(-1, 2), segment.reshape(2, 2)])
+        tolerance = 2.0 / grid if grid else 1e-9
+        # 交点（と枠の上の端点）が乗っている辺を探し、その点で分割する
+        tree = shapely.STRtree(shapely.linestrings(edges))
+        point_ids, edge_ids = tree.query(shapely.points(points), predicate='dwithin', distance=tolerance)
+        on_edge = {}
+        for p, e in zip(point_ids.tolist(), edge_ids.tolist()):
+            if not ((points[p] == edges[e, 0]).all() or (points[p] == edges[e, 1]).all()):
+                on_edge.setdefault(e, []).append(points[p])
+        pieces = [edges[np.setdiff1d(np.arange(len(edges)), list(on_edge))]]
+        for e, pts in on_edge.items():
+            pieces.append(_split_at(edges[e], np.array(pts)))
+        pieces.append(_split_at(segment, crossings.reshape(-1, 2)))
+        noded = np.concatenate(pieces)
+    if grid:
+        noded = _unique_segments(noded)
+    return _within_parents(polygonize_segments(noded), polygons)
+
+def _within_parents(pieces: List[Polygon], polygons: List[Polygon]) -> List[Polygon]:
+    # 元の領域に囲まれているだけの隙間（別の領域）も面になるので、元の領域の中にあるものだけ残す
+    if not pieces:
+        return pieces
+    tree = shapely.STRtree(polygons)
+    inside = np.unique(tree.query(shapely.point_on_surface(pieces), predicate='covered_by')[0])
+    return [pieces[i] for i in inside.tolist()]
+
+def _split_at(segment: np.ndarray, points: np.ndarray) -> np.ndarray:
+    # 線分を、その上にある点で区切った線分の配列にする
+    d = segment[1] - segment[0]
+    order = np.argsort((points - segment[0]) @ d)
+    chain = np.concatenate([segment[:1], points[order], segment[1:]])
+    pieces = np.stack([chain[:-1], chain[1:]], axis=1)
+    return pieces[(pieces[:, 0] != pieces[:, 1]).any(axis=1)]
+
+def has_edge_on(polygon: Polygon, segment: np.ndarray, tolerance: float = 1e-7) -> bool:
+    """
+    polygon の外周に、線分の上に乗っている辺があるかどうか
+    """
+    coords = shapely.get_coordinates(polygon.exterior)
+    near = shapely.distance(shapely.points(coords), LineString(segment)) <= tolerance
+    return bool((near[1:] & near[:-1]).any())
+
+def _overlap(edge: np.ndarray, other: np.ndarray, tolerance: float) -> list:
+    # edge のうち、線分 other に重なっている部分（なければ空）。短い辺は向きが不正確なので、other を基準に測る
+    d = other[1] - other[0]
+    length2 = float(d @ d)
+    if length2 == 0:
+        return []
+    rel = edge - other[0]
+    # edge の両端が other の直線から tolerance 以内になければ、交わっているだけ
+    if (np.abs(rel[:, 0] * d[1] - rel[:, 1] * d[0]) > tolerance * np.sqrt(length2)).any():
+        return []
+    s0, s1 = (rel @ d / length2).tolist()
+    lo, hi = max(min(s0, s1), 0.0), min(max(s0, s1), 1.0)
+    if (hi - lo) * np.sqrt(length2) <= tolerance:
+        return []
+    # other の中にある edge の端はそのまま使う（ほかの辺と頂点の座標をそろえるため）
+    def point(s, end):
+        return end if 0.0 <= s <= 1.0 else other[0] + d * min(max(s, 0.0), 1.0)
+    return [np.array([point(s0, edge[0]), point(s1, edge[1])])]
+
+def merge_regions(polygons: List[Polygon], segment: np.ndarray, tolerance: float = 1e-7, others: np.ndarray = None) -> List[Polygon]:
+    """
+    線分で区切られている領域の集まりから、その線分を取り除いて領域を作り直す。
+    others（残っている線の線分）に重なる辺は、同じ線がまだあるので取り除かない
+    """
+    edges = ring_segments(polygons)
+    seg = LineString(segment)
+    on_line = shapely.distance(shapely.points(edges.reshape(-1, 2)), seg).reshape(-1, 2) <= tolerance
+    drop = on_line.all(axis=1)
+    kept = []
+    if others is not None and len(others) and drop.any():
+        # 線の上の辺のうち、残っている線と重なっている部分は残す
+        tree = shapely.STRtree(shapely.linestrings(others))
+        ids = np.flatnonzero(drop)
+        edge_ids, other_ids = tree.query(shapely.linestrings(edges[ids]), predicate='dwithin', distance=tolerance)
+        for e, o in zip(ids[edge_ids].tolist(), other_ids.tolist()):
+            kept.extend(_overlap(edges[e], others[o], tolerance))
+    edges = edges[~drop]
+    if kept:
+        edges = np.concatenate([edges, np.array(kept, dtype=float).reshape(-1, 2, 2)])
+    # 取り除いた線の上に残った次数2の頂点（交点や枠上の端点の跡）をつなぎ直す。
+    # 残っている線（枠も含む）の途中の点だけが対象なので、2本の辺が一直線に続くときに限る（枠の角などはつながない）
+    keys = [tuple(p) for p in edges.reshape(-1, 2)]
+    incident = {}
+    for i, key in enumerate(keys):
+        incident.setdefault(key, []).append(i // 2)
+    alive = [[tuple(e[0]), tuple(e[1])] for e in edges]
+    removed = set()
+    for key, idxs in incident.items():
+        if len(idxs) != 2 or seg.distance(Point(key)) > tolerance:
+            continue
+        i, j = idxs
+        a = alive[i][1] if alive[i][0] == key else alive[i][0]
+        b = alive[j][1] if alive[j][0] == key else alive[j][0]
+        da, db = np.subtract(a, key), np.subtract(b, key)
+        # 格子に丸めた交点は線から格子1目ほどずれるので、a-b から key までの距離で、少し広めに見る
+        if np.dot(da, db) >= 0 or abs(da[0] * db[1] - da[1] * db[0]) > 4 * tolerance * np.hypot(*(db - da)):
+            continue
+        # i の key 側の端を j の反対側の端 b に置き換え、j を捨てる
+        side = 0 if alive[i][0] == key else 1
+        alive[i][side] = b
+        removed.add(j)
+        for k in incident[b]:
+            if k == j:
+                incident[b][incident[b].index(k)] = i
+    merged = np.array([e for k, e in enumerate(alive) if k not in removed], dtype=float).reshape(-1, 2, 2)
+    return _within_parents(polygonize_segments(merged), polygons)
+
+def chain_segments(lines, grid=None) -> List[List[tuple]]:
+    """
+    端点を共有する線をつないで、できるだけ少ない本数の折れ線にする。
+    端点をハッシュして頂点にし、連結成分ごとに奇数次の頂点どうしを仮の辺で結んで
+    オイラー閉路をたどり、仮の辺のところで切り分ける（3本以上が集まる分岐点も扱える）。
+    lines は座標列（LineString や (N, 2) 配列）のリスト、または線分の (M, 2, 2) 配列。
+    grid があれば端点は格子番号で突き合わせる
+    """
+    paths = [np.asarray(getattr(line, 'coords', line), dtype=float).reshape(-1, 2) for line in lines]
+    paths = [p for p in paths if len(p) >= 2]
+    vertex_of = {}
+    ends = []
+    for p in paths:
+        if grid:
+            first, last = grid_keys(p[[0, -1]], grid).tolist()
+        else:
+            first, last = p[0].tolist(), p[-1].tolist()
+        u = vertex_of.setdefault(tuple(first), len(vertex_of))
+        v = vertex_of.setdefault(tuple(last), len(vertex_of))
+        ends.append((u, v))
+    n = len(vertex_of)
+    adjacency = [[] for _ in range(n)]
+    for e, (u, v) in enumerate(ends):
+        adjacency[u].append(e)
+        adjacency[v].append(e)
+
+    # 連結成分ごとに奇数次の頂点を仮の辺で2つずつ結ぶ
+    real_edges = len(ends)
+    starts = []
+    seen = [False] * n
+    for start in range(n):
+        if seen[start]:
+            continue
+        starts.append(start)
+        odd = []
+        seen[start] = True
+        stack = [start]
+        while stack:
+            x = stack.pop()
+            if len(adjacency[x]) % 2:
+                odd.append(x)
+            for e in adjacency[x]:
+                u, v = ends[e]
+                y = v if u == x else u
+                if not seen[y]:
+                    seen[y] = True
+                    stack.append(y)
+        for i in range(0, len(odd), 2):
+            adjacency[odd[i]].append(len(ends))
+            adjacency[odd[i + 1]].append(len(ends))
+            ends.append((odd[i], odd[i + 1]))
+
+    used = [False] * len(ends)
+    cursor = [0] * n
+    polylines = []
+    for start in starts:
+        # Hierholzer 法でオイラー閉路を (到着した頂点, 通った辺) の列として求める
+        circuit = []
+        stack = [(start, -1)]
+        while stack:
+            x, _ = stack[-1]
+            adj = adjacency[x]
+            while cursor[x] < len(adj) and used[adj[cursor[x]]]:
+                cursor[x] += 1
+            if cursor[x] == len(adj):
+                circuit.append(stack.pop())
+                continue
+            e = adj[cursor[x]]
+            used[e] = True
+            u, v = ends[e]
+            stack.append((v if u == x else u, e))
+        circuit.reverse()
+        steps = circuit[1:]
+        if not steps:
+            continue
+        # 仮の辺の直後から始まるように回してから、仮の辺で区切る
+        virtual = [i for i, (_, e) in enumerate(steps) if e >= real_edges]
+        if virtual:
+            steps = steps[virtual[0] + 1:] + steps[:virtual[0] + 1]
+        prev = steps[-1][0]
+        current = None
+        for x, e in steps:
+            if e >= real_edges:
+                if current:
+                    polylines.append(current)
+                current = None
+            else:
+                p = paths[e] if ends[e][0] == prev else paths[e][::-1]
+                if current is None:
+                    current = [tuple(c) for c in p.tolist()]
+                else:
+                    current.extend(tuple(c) for c in p[1:].tolist())
+            prev = x
+        if current:
+            polylines.append(current)
+    return polylines
@@ -0,0 +1,213 @@
+from collections import deque
+
+import numpy as np
+import shapely
+
+_ENTRY_OVERHEAD = 256  # 変更1件あたりの配列以外の大きさの見積もり（バイト）
+
+def _pack(rgba) -> int:
+    # RGBA を1つの整数に詰める（塗りがなければ -1）
+    if rgba is None:
+        return -1
+    r, g, b, a = rgba
+    return (r << 24) | (g << 16) | (b << 8) | a
+
+def _unpack(value: int):
+    if value < 0:
+        return None
+    return ((value >> 24) & 255, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+def _pack_fills(fills):
+    # {領域インデックス: RGBA} を (インデックスの配列, 詰めた RGBA の配列) にする
+    ids = np.fromiter(fills.keys(), dtype=np.int32, count=len(fills))
+    packed = np.fromiter((_pack(rgba) for rgba in fills.values()), dtype=np.int64, count=len(fills))
+    return ids, packed
+
+class FillChange:
+    """
+    1回のストローク（押してから離すまで）で変えた塗り。
+    記録中は辞書に、finish のあとは領域インデックスと前後の RGBA の配列に詰めて持つ
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.numbering = layer.numbering  # 記録したときの領域インデックスの振り方
+        self._changes = {}  # 領域インデックス -> (ストローク前の RGBA, 最後の RGBA)
+        self.ids = self.old = self.new = None
+
+    def record(self, idx, old, new):
+        """
+        領域 idx の塗りが old から new に変わったことを記録する
+        """
+        first = self._changes.get(idx)
+        self._changes[idx] = (first[0] if first else old, new)
+
+    def finish(self) -> bool:
+        """
+        記録を配列に詰める。何か変わっていれば True
+        """
+        items = [(idx, old, new) for idx, (old, new) in self._changes.items() if old != new]
+        self._changes = None
+        self.ids = np.fromiter((idx for idx, _, _ in items), dtype=np.int32, count=len(items))
+        self.old = np.fromiter((_pack(old) for _, old, _ in items), dtype=np.int64, count=len(items))
+        self.new = np.fromiter((_pack(new) for _, _, new in items), dtype=np.int64, count=len(items))
+        return len(items) > 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.old.nbytes + self.new.nbytes + _ENTRY_OVERHEAD
+
+    @property
+    def stale(self) -> bool:
+        """
+        記録したあとで領域インデックスが付け替えられていれば True（インデックスがもう同じ領域を指さない）
+        """
+        return self.layer.numbering != self.numbering
+
+    def undo(self):
+        self.layer.update_fills(dict(zip(self.ids.tolist(), map(_unpack, self.old.tolist()))))
+
+    def redo(self):
+        self.layer.update_fills(dict(zip(self.ids.tolist(), map(_unpack, self.new.tolist()))))
+
+class LineChange:
+    """
+    線の引き直し。シードで作った線はシードと本数だけ、それ以外は座標の配列で、塗りと一緒に前後の状態を持つ。
+    戻すときは線から領域を作り直すので、並びが崩れたレイヤーは先にそろえてから記録する
+    """
+
+    stale = False  # レイヤーごと戻すので、インデックスが付け替えられていても使える
+
+    def __init__(self, layer):
+        self.layer = layer
+        layer.canonicalize()
+        self.before = self._capture(layer)
+        self.after = None
+
+    def finish(self) -> bool:
+        """
+        変更後の状態を記録する
+        """
+        self.after = self._capture(self.layer)
+        return True
+
+    @staticmethod
+    def _capture(layer):
+        lines = layer.lines or []
+        coords = offsets = None
+        if layer.seed is None and lines:
+            coords, index = shapely.get_coordinates(np.asarray(lines, dtype=object), return_index=True)
+            offsets = np.searchsorted(index, np.arange(len(lines) + 1))
+        ids, packed = _pack_fills(layer.fills)
+        return {'size': layer.size, 'seed': layer.seed, 'count': len(lines), 'numbering': layer.numbering,
+                'coords': coords, 'offsets': offsets, 'ids': ids, 'fills': packed}
+
+    @staticmethod
+    def _restore(layer, state):
+        w, h = state['size']
+        if state['seed'] is not None:
+            layer.generate(w, h, state['count'], seed=state['seed'])
+        else:
+            lines = []
+            if state['offsets'] is not None:
+                offsets = state['offsets']
+                indices = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+                lines = list(shapely.linestrings(state['coords'], indices=indices))
+            layer.set_lines(w, h, lines)
+        # 同じ線から作り直した領域は記録したときと同じインデックスになるので、その前後の塗りの変更もまた使える
+        layer.numbering = state['numbering']
+        layer.update_fills(dict(zip(state['ids'].tolist(), map(_unpack, state['fills'].tolist()))))
+
+    @property
+    def nbytes(self) -> int:
+        total = _ENTRY_OVERHEAD
+        for state in (self.before, self.after):
+            for name in ('coords', 'offsets', 'ids', 'fills'):
+                if isinstance(state[name], np.ndarray):
+                    total += state[name].nbytes
+        return total
+
+    def undo(self):
+        self._restore(self.layer, self.before)
+
+    def redo(self):
+        self._restore(self.layer, self.after)
+
+class History:
+    """
+    元に戻す／やり直しの履歴。変更の差分だけを持ち、合計が max_bytes を超えたら古いものから捨てる
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self._undo = deque()
+        self._redo = []
+        self.nbytes = 0  # 履歴全体の大きさの見積もり（バイト）
+
+    def push(self, change):
+        """
+        変更を積む。やり直しの履歴は捨てる
+        """
+        for redo in self._redo:
+            self.nbytes -= redo.nbytes
+        self._redo.clear()
+        self._undo.append(change)
+        self.nbytes += change.nbytes
+        # 直前の変更だけは、上限を超えていても残す
+        while self.nbytes > self.max_bytes and len(self._undo) > 1:
+            self.nbytes -= self._undo.popleft().nbytes
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+    def undo(self):
+        """
+        直前の変更を元に戻して返す（なければ None）。領域インデックスが付け替えられて使えなくなった変更は捨てる
+        """
+        while self._undo:
+            change = self._undo.pop()
+            if change.stale:
+                self.nbytes -= change.nbytes
+                continue
+            change.undo()
+            self._redo.append(change)
+            return change
+        return None
+
+    def redo(self):
+        """
+        元に戻した変更をやり直して返す（なければ None）。使えなくなった変更は捨てる
+        """
+        while self._redo:
+            change = self._redo.pop()
+            if change.stale:
+                self.nbytes -= change.nbytes
+                continue
+            change.redo()
+            self._undo.append(change)
+            return change
+        return None
+
+    def retain(self, layers):
+        """
+        layers にないレイヤー（削除したもの）への変更を捨てる。
+        変更はレイヤーを参照しているので、残しておくと削除したレイヤーが解放されない
+        """
+        live = {id(layer) for layer in layers}
+        for stack in (self._undo, self._redo):
+            kept = [change for change in stack if id(change.layer) in live]
+            for change in stack:
+                if id(change.layer) not in live:
+                    self.nbytes -= change.nbytes
+            stack.clear()
+            stack.extend(kept)
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self.nbytes = 0
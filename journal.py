@@ -0,0 +1,253 @@
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+
+JOURNAL_SUFFIX = '.journal'
+LAYER_PROPS = ('name', 'visible', 'save_mode', 'merge_fills', 'line_rgba', 'line_width')  # 記録するレイヤーの見た目と設定
+
+def journal_path(path) -> str:
+    """
+    プロジェクトファイルに対応するジャーナルのパス
+    """
+    return str(path) + JOURNAL_SUFFIX
+
+def _layer_props(layer) -> dict:
+    props = {name: getattr(layer, name) for name in LAYER_PROPS}
+    props['line_rgba'] = list(props['line_rgba'])
+    return props
+
+def _layer_data(layer) -> dict:
+    # 写しを書き出す（to_json は領域の並びをそろえるので、画面のレイヤーには触らない）。
+    # シードから作り直せる線は書かない（数十バイトで済む）
+    data = layer.snapshot().to_json()
+    if data.get('seed') is not None:
+        del data['lines']
+    return data
+
+class _TrackedLayer:
+    # 最後に記録したときのレイヤーの状態
+    def __init__(self, layer):
+        self.layer = layer
+        self.geometry_version = layer.geometry_version
+        self.fill_version = layer.fill_version
+        self.fills = dict(layer.fills)
+        self.props = _layer_props(layer)
+
+class Journal:
+    """
+    プロジェクトファイルの横に置く追記専用の操作ログ（1行1操作の JSON）。
+    sync で前回からのレイヤーの変化（塗り・レイヤーの追加と削除・設定の変更）を操作として記録し、
+    書き込みは別スレッドでまとめて行う。1行目の見出しの id がプロジェクトファイルの journal_id と一致するときだけ、
+    読み込み時に journal_seq より後の操作を再生する
+    """
+
+    def __init__(self, path, token=None, seq=0):
+        """
+        token を省くと新しいジャーナルを作る。token がいまのジャーナルの id と同じなら、その続きに追記する
+        """
+        self.path = path  # プロジェクトファイルのパス
+        self.token = token or uuid.uuid4().hex
+        self.seq = seq  # 最後に記録した操作の通し番号
+        self._tracked = []
+        self._pending = []  # まだ書いていない行
+        self._lock = threading.Lock()  # _pending を守る
+        self._file_lock = threading.Lock()  # ファイルへの書き込みと差し替えを守る
+        self._wakeup = threading.Event()
+        self._closed = False
+        if _read_header(path) != self.token:
+            # 新しいジャーナルは見出しから書き始める（同じ名前の、別のプロジェクトファイルのジャーナルは捨てる）
+            with open(journal_path(path), 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'journal': self.token}) + '\n')
+        else:
+            # 書きかけで終わった行があれば、続きの操作がその行につながらないよう改行しておく
+            with open(journal_path(path), 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+        self._file = open(journal_path(path), 'a', encoding='utf-8')
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @property
+    def size(self) -> int:
+        """
+        ジャーナルファイルの大きさ（バイト）
+        """
+        with self._file_lock:
+            return self._file.tell()
+
+    def track(self, layers, numberings=None):
+        """
+        いまのレイヤーの状態を、記録済みの状態とする。
+        numberings（ファイルとジャーナルのとおりに読んだときの各レイヤーの Layer.numbering）を渡すと、
+        そのあと領域を作るときに塗りを探し直して領域インデックスが変わったレイヤーは、次の sync でレイヤーごと書き直す
+        """
+        self._tracked = [_TrackedLayer(layer) for layer in layers]
+        if numberings is not None:
+            for state, numbering in zip(self._tracked, numberings):
+                if state.layer.numbering != numbering:
+                    state.geometry_version = None
+
+    def sync(self, layers):
+        """
+        前回からのレイヤーの変化を操作として記録する（GUI スレッドから呼ぶ）
+        """
+        tracked = {id(state.layer): state for state in self._tracked}
+        current = {id(layer) for layer in layers}
+        kept = [state.layer for state in self._tracked if id(state.layer) in current]
+        if [id(layer) for layer in kept] != [id(layer) for layer in layers if id(layer) in tracked]:
+            # 並べ替えられたときは、すべて消して追加し直す
+            kept = []
+        kept = {id(layer) for layer in kept}
+        # 消えたレイヤーを後ろから消してから、新しいレイヤーを追加する
+        for i in reversed(range(len(self._tracked))):
+            if id(self._tracked[i].layer) not in kept:
+                self._record({'op': 'delete_layer', 'index': i})
+        for i, layer in enumerate(layers):
+            if id(layer) not in kept:
+                self._record({'op': 'add_layer', 'index': i, 'layer': _layer_data(layer)})
+                tracked[id(layer)] = _TrackedLayer(layer)
+                continue
+            state = tracked[id(layer)]
+            if layer.geometry_version != state.geometry_version or \
+                    (not layer.canonical and layer.fill_version != state.fill_version):
+                # 線が変わると領域インデックスも変わるので、レイヤーごと置き換える。
+                # 線を足し引きして並びが崩れたレイヤーは、インデックスが書き出すときの並びと違うので、塗りの変更もレイヤーごと書く
+                self._record({'op': 'replace_layer', 'index': i, 'layer': _layer_data(layer)})
+                tracked[id(layer)] = _TrackedLayer(layer)
+                continue
+            props = _layer_props(layer)
+            changed = {name: value for name, value in props.items() if state.props[name] != value}
+            if changed:
+                self._record({'op': 'layer', 'index': i, 'props': changed})
+                state.props = props
+            if layer.fill_version != state.fill_version:
+                fills = layer.fills
+                ids = [idx for idx, rgba in fills.items() if state.fills.get(idx) != rgba]
+                ids += [idx for idx in state.fills if idx not in fills]
+                if ids:
+                    rgba = [list(fills[idx]) if idx in fills else None for idx in ids]
+                    # 読み込んだ環境で領域の並びが違っていても置き場所を探し直せるよう、塗った領域の形も書く
+                    painted = [idx for idx in ids if idx in fills]
+                    shapes = dict(zip(painted, np.round(layer.fill_shapes(painted), 4).tolist()))
+                    self._record({'op': 'fill', 'index': i, 'ids': ids, 'rgba': rgba,
+                                  'shapes': [shapes.get(idx) for idx in ids]})
+                state.fills = dict(fills)
+                state.fill_version = layer.fill_version
+        self._tracked = [tracked[id(layer)] for layer in layers]
+
+    def _record(self, op):
+        self.seq += 1
+        line = json.dumps({'seq': self.seq, **op}, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._pending.append(line)
+        self._wakeup.set()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        記録した操作をファイルに書き出す
+        """
+        with self._file_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+            if lines:
+                self._file.write(''.join(lines))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+
+    def compact(self, seq):
+        """
+        seq までの操作がプロジェクトファイルに入ったので、それより後の操作だけを残してジャーナルを書き直す
+        """
+        from project_io import atomic_replace
+        self.flush()
+        with self._file_lock:
+            self._file.close()
+            path = journal_path(self.path)
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            with atomic_replace(path) as tmp:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(lines[0])
+                    for line in lines[1:]:
+                        op = _parse(line)
+                        if op is not None and op['seq'] > seq:
+                            f.write(line)
+            self._file = open(path, 'a', encoding='utf-8')
+
+    def close(self):
+        """
+        書き残しを書き出して閉じる
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        self._file.close()
+
+def _read_header(path):
+    # ジャーナルの id（ないか読めなければ None）
+    if not os.path.exists(journal_path(path)):
+        return None
+    with open(journal_path(path), 'r', encoding='utf-8') as f:
+        header = _parse(f.readline())
+    return header.get('journal') if isinstance(header, dict) else None
+
+def _parse(line):
+    # 書きかけで終わった最後の行は読み飛ばす
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+def replay_journal(project, path) -> int:
+    """
+    path のジャーナルのうち、project に入っていない操作を再生する。
+    操作の領域インデックスは書いたときの並びなので、領域を作る（Project.prepare）前に再生する。
+    再生した最後の通し番号（ジャーナルがない、または別のプロジェクトのものなら project.journal_seq）を返す
+    """
+    if project.journal_id is None or _read_header(path) != project.journal_id:
+        return project.journal_seq
+    with open(journal_path(path), 'r', encoding='utf-8') as f:
+        f.readline()
+        seq = project.journal_seq
+        for line in f:
+            op = _parse(line)
+            if op is None or op['seq'] <= seq:
+                continue
+            apply_op(project, op)
+            seq = op['seq']
+    return seq
+
+def apply_op(project, op):
+    """
+    ジャーナルの操作を1つ project に反映する
+    """
+    from canvas import Layer
+    kind = op['op']
+    if kind == 'fill':
+        changes = {idx: (tuple(rgba) if rgba is not None else None) for idx, rgba in zip(op['ids'], op['rgba'])}
+        shapes = {idx: shape for idx, shape in zip(op['ids'], op.get('shapes', [])) if shape is not None}
+        project.layers[op['index']].update_fills(changes, shapes)
+    elif kind == 'layer':
+        layer = project.layers[op['index']]
+        for name, value in op['props'].items():
+            if name in LAYER_PROPS:
+                setattr(layer, name, tuple(value) if name == 'line_rgba' else value)
+    elif kind == 'add_layer':
+        project.layers.insert(op['index'], Layer.from_json(project.width, project.height, op['layer'], project.grid))
+    elif kind == 'replace_layer':
+        project.layers[op['index']] = Layer.from_json(project.width, project.height, op['layer'], project.grid)
+    elif kind == 'delete_layer':
+        project.layers.pop(op['index'])
+    else:
+        raise ValueError(f"ジャーナルに不明な操作があります: {kind}")
@@ -1,12 +1,12 @@
 from typing import List
-from PyQt6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QRadioButton, QButtonGroup
+from PyQt6.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QRadioButton, QButtonGroup, QCheckBox
 from canvas import Layer
 
 class LayerPropertiesDialog(QDialog):
     def __init__(self, parent=None, layer_name=""):
         super().__init__(parent)
         self.setWindowTitle("レイヤー情報編集")
-        self.setFixedSize(500, 240)
+        self.setFixedSize(500, 270)
         layout = QVBoxLayout()
         hlayout_name = QHBoxLayout()
         self.name_edit = QLineEdit(layer_name)
@@ -25,6 +25,9 @@ class LayerPropertiesDialog(QDialog):
         for radio in self.save_mode_radios:
             layout.addWidget(radio)
         self.save_mode_radios[0].setChecked(True)
+        # 同じ色の塗りをまとめる（SVG保存時）
+        self.merge_fills_checkbox = QCheckBox("隣り合う同じ色の塗りを1つの図形にまとめる（SVG）")
+        layout.addWidget(self.merge_fills_checkbox)
         ok_btn = QPushButton("OK")
         cancel_btn = QPushButton("キャンセル")
         btn_layout = QHBoxLayout()
@@ -38,4 +41,6 @@ class LayerPropertiesDialog(QDialog):
         return self.name_edit.text()
     def get_save_mode(self):
         return self.save_mode_group.checkedId()
+    def get_merge_fills(self):
+        return self.merge_fills_checkbox.isChecked()
 
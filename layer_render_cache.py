@@ -0,0 +1,202 @@
+import math
+
+import numpy as np
+from PyQt6.QtCore import QLineF, QPointF, QRect, Qt
+from PyQt6.QtGui import QBrush, QColor, QImage, QPainter, QPainterPath, QPainterPathStroker, QPen, QPixmap, QPolygonF
+
+import shapely
+
+from geom import line_segments
+
+class LayerRenderCache:
+    """
+    レイヤーを画面に描くための Qt オブジェクトをまとめて保持する。
+    線・領域の QPolygonF / QLineF は geometry_version が変わったときだけ作り直す
+    """
+
+    def __init__(self, layer):
+        self.layer = layer
+        self.geometry_version = None
+        self._polygons = {}  # 領域インデックス -> QPolygonF（必要になったものから作る）
+        self._lines = []
+        self._region_bounds = None  # 領域ごとの (minx, miny, maxx, maxy)
+        self._line_bounds = None
+        self._colors = {}
+        self._pen = None
+        self._pen_key = None
+        self._line_outlines = []  # 線ごとの輪郭（太さを反映済み）の QPainterPath
+        self._line_outlines_key = None
+        self._surface: QImage = None  # レイヤーだけを描いたオフスクリーン画像
+        self._surface_key = None  # 最後に描いたときの (形状, 塗り, 線の見た目, 大きさ)
+
+    @staticmethod
+    def of(layer) -> 'LayerRenderCache':
+        """
+        レイヤーに付いているキャッシュを返す（なければ作る）
+        """
+        if layer.render_cache is None:
+            layer.render_cache = LayerRenderCache(layer)
+        return layer.render_cache
+
+    def _sync(self):
+        if self.geometry_version == self.layer.geometry_version:
+            return
+        self._polygons = {}
+        self._region_bounds = shapely.bounds(np.asarray(self.layer.regions, dtype=object)).reshape(-1, 4)
+        segments = line_segments(self.layer.lines or []).astype(int)
+        self._lines = [QLineF(x1, y1, x2, y2) for (x1, y1), (x2, y2) in segments.tolist()]
+        self._line_bounds = np.concatenate([segments.min(axis=1), segments.max(axis=1)], axis=1)
+        self.geometry_version = self.layer.geometry_version
+
+    def forget_regions(self):
+        """
+        領域インデックスに結びついた図形を捨てる（領域を手放したときや番号を付け直したとき）。
+        オフスクリーン画像は見た目が変わらないので残す
+        """
+        self.geometry_version = None
+        self._polygons = {}
+        self._region_bounds = None
+        self._lines = []
+        self._line_bounds = None
+        self._line_outlines = []
+        self._line_outlines_key = None
+
+    def polygon(self, idx) -> QPolygonF:
+        self._sync()
+        poly = self._polygons.get(idx)
+        if poly is None:
+            coords = shapely.get_coordinates(self.layer.regions[idx].exterior).astype(int)
+            poly = QPolygonF([QPointF(x, y) for x, y in coords.tolist()])
+            self._polygons[idx] = poly
+        return poly
+
+    def lines(self):
+        self._sync()
+        return self._lines
+
+    def color(self, rgba) -> QColor:
+        qcolor = self._colors.get(rgba)
+        if qcolor is None:
+            qcolor = self._colors[rgba] = QColor(*rgba)
+        return qcolor
+
+    def line_pen(self) -> QPen:
+        key = (tuple(self.layer.line_rgba), self.layer.line_width)
+        if self._pen_key != key:
+            self._pen = QPen(QColor(*key[0]))
+            self._pen.setWidth(key[1])
+            self._pen_key = key
+        return self._pen
+
+    def line_outlines(self):
+        """
+        線ごとの輪郭を返す。ペンで線を引くとクリップ範囲によってラスタライズ結果が変わるので、
+        輪郭を塗りつぶして描く（部分的に描き直しても全体を描いたときと同じ画素になる）
+        """
+        self._sync()
+        key = (self.geometry_version, self.layer.line_width)
+        if self._line_outlines_key != key:
+            stroker = QPainterPathStroker(self.line_pen())
+            self._line_outlines = []
+            for line in self._lines:
+                path = QPainterPath(line.p1())
+                path.lineTo(line.p2())
+                self._line_outlines.append(stroker.createStroke(path))
+            self._line_outlines_key = key
+        return self._line_outlines
+
+    def draw(self, painter: QPainter, rect: QRect = None):
+        """
+        塗り領域と線をキャンバスと同じ見た目で描く。rect を渡すとそこに掛からないものは描かない
+        """
+        self._sync()
+        fills = self.layer.fills
+        lines = self.line_outlines()
+        if rect is not None and fills:
+            # 塗りの線幅と int への切り捨ての分だけ広げて判定する
+            ids = np.fromiter(fills.keys(), dtype=np.int64, count=len(fills))
+            hit = _intersects(self._region_bounds[ids], rect, 2)
+            fills = {int(i): fills[int(i)] for i in ids[hit]}
+        if rect is not None and lines:
+            hit = np.nonzero(_intersects(self._line_bounds, rect, self.layer.line_width + 1))[0]
+            lines = [lines[i] for i in hit]
+        for idx, rgba in fills.items():
+            qcolor = self.color(rgba)
+            painter.setBrush(qcolor)
+            painter.setPen(qcolor)
+            painter.drawPolygon(self.polygon(idx))
+        # 線描画（レイヤーごとの色と太さ）
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(self.color(tuple(self.layer.line_rgba)))
+        for outline in lines:
+            painter.drawPath(outline)
+
+    def surface(self, width, height, device_pixel_ratio=1.0) -> QImage:
+        """
+        レイヤーだけを描いたオフスクリーン画像を返す。
+        形状・塗り・線の色や太さ・大きさのどれかが変わったときだけ描き直す
+        """
+        # 描き直さないときは領域に触れない（手放した領域を作り直さずに済む）
+        key = (self.layer.geometry_version, self.layer.fill_version,
+               (tuple(self.layer.line_rgba), self.layer.line_width),
+               (width, height, device_pixel_ratio))
+        if self._surface_key == key:
+            return self._surface
+        damage = self.layer.fill_damage
+        if (self._surface is not None and damage and self._surface_key[0] == key[0]
+                and self._surface_key[2:] == key[2:]):
+            # 塗りだけが変わったときは、変わった範囲だけを描き直す
+            rect = damage_rect(damage, self.layer.line_width)
+            painter = QPainter(self._surface)
+            painter.setClipRect(rect)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_Source)
+            painter.fillRect(rect, Qt.GlobalColor.transparent)
+            painter.setCompositionMode(QPainter.CompositionMode.CompositionMode_SourceOver)
+            self.draw(painter, rect)
+            painter.end()
+        else:
+            if self._surface is None or self._surface_key[3] != key[3]:
+                self._surface = QImage(round(width * device_pixel_ratio), round(height * device_pixel_ratio),
+                                       QImage.Format.Format_ARGB32_Premultiplied)
+                self._surface.setDevicePixelRatio(device_pixel_ratio)
+            self._surface.fill(Qt.GlobalColor.transparent)
+            painter = QPainter(self._surface)
+            self.draw(painter)
+            painter.end()
+        self.layer.fill_damage = []
+        self._surface_key = key
+        return self._surface
+
+def _intersects(bounds: np.ndarray, rect: QRect, margin) -> np.ndarray:
+    # bounds の各行 (minx, miny, maxx, maxy) が rect（margin だけ広げる）に掛かるか
+    return ((bounds[:, 2] >= rect.left() - margin) & (bounds[:, 0] <= rect.right() + 1 + margin) &
+            (bounds[:, 3] >= rect.top() - margin) & (bounds[:, 1] <= rect.bottom() + 1 + margin))
+
+def damage_rect(bounds, line_width) -> QRect:
+    """
+    変更された範囲 (minx, miny, maxx, maxy) のリストをまとめ、線の太さの分だけ広げた QRect を返す
+    """
+    b = np.asarray(bounds, dtype=float).reshape(-1, 4)
+    margin = line_width + 2
+    x1 = math.floor(b[:, 0].min()) - margin
+    y1 = math.floor(b[:, 1].min()) - margin
+    x2 = math.ceil(b[:, 2].max()) + margin
+    y2 = math.ceil(b[:, 3].max()) + margin
+    return QRect(x1, y1, x2 - x1, y2 - y1)
+
+_checker_brush = None
+
+def checker_brush(checker_size=20) -> QBrush:
+    """
+    αチェッカー（市松模様）のタイル状ブラシを返す
+    """
+    global _checker_brush
+    if _checker_brush is None:
+        tile = QPixmap(checker_size * 2, checker_size * 2)
+        tile.fill(Qt.GlobalColor.white)
+        painter = QPainter(tile)
+        painter.fillRect(0, 0, checker_size, checker_size, Qt.GlobalColor.lightGray)
+        painter.fillRect(checker_size, checker_size, checker_size, checker_size, Qt.GlobalColor.lightGray)
+        painter.end()
+        _checker_brush = QBrush(tile)
+    return _checker_brush
@@ -4,12 +4,16 @@ import PyQt6.QtCore as qt
 from PyQt6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout,
     QMenuBar, QMenu, QLabel, QPushButton, QHBoxLayout, QLineEdit,
-    QListWidget, QListWidgetItem, QSpinBox, QCheckBox, QVBoxLayout, QLabel, QPushButton, QFileDialog
+    QListWidget, QListWidgetItem, QSpinBox, QCheckBox, QVBoxLayout, QLabel, QPushButton, QFileDialog,
+    QMessageBox, QProgressBar
 )
-from PyQt6.QtGui import QAction
+from PyQt6.QtGui import QAction, QKeySequence
 
-from geom import create_regions, generate_lines
-from canvas import Canvas, Layer
+from canvas import Canvas, Layer, Project
+from history import LineChange
+from cancellation import CancelToken, RenderCancelled
+from project_io import is_binary_project
+from journal import Journal, replay_journal
 
 from canvas_dialog import CanvasDialog
 from layer_properties_dialog import LayerPropertiesDialog
@@ -19,24 +23,90 @@ from progress_bar_dialog import ProgressBarDialog
 
 class CanvasExportWorker(qt.QObject):
     finished = qt.pyqtSignal()
+    progressChanged = qt.pyqtSignal(float)  # 0.0〜1.0
 
-    def __init__(self, canvas, path, antialiasing=False, progress_callback=None):
+    def __init__(self, canvas, path, antialiasing=False, scale=1):
         super().__init__()
         self.canvas: Canvas = canvas
         self.path = path
         self.antialiasing = antialiasing
-        self.progress_callback = progress_callback
+        self.scale = scale
+        self.cancel_token = CancelToken()
+        self.cancelled = False
 
     def run(self):
-        if self.path.lower().endswith('.svg'):
-            self.canvas.to_svg(self.path)
-        else:
-            image = self.canvas.to_qimage(self.antialiasing, self.progress_callback)
-            image.save(self.path)
-        self.finished.emit()
+        # 進み具合はシグナルで GUI スレッドに渡す
+        progress_callback = self.progressChanged.emit
+        try:
+            if self.path.lower().endswith(('.svg', '.svgz')):
+                self.canvas.to_svg(self.path, progress_callback=progress_callback, cancel=self.cancel_token)
+            elif self.path.lower().endswith('.png'):
+                # PNG は帯ごとに描いて書き出す（大きな画像でもメモリを使い切らない）
+                self.canvas.export_png(self.path, self.scale, self.antialiasing, progress_callback, cancel=self.cancel_token)
+            else:
+                image = self.canvas.to_qimage(self.antialiasing, progress_callback, parallel=True, cancel=self.cancel_token)
+                image.save(self.path)
+        except RenderCancelled:
+            self.cancelled = True
+        finally:
+            self.finished.emit()
+
+class ProjectLoadWorker(qt.QObject):
+    finished = qt.pyqtSignal()
+    progressChanged = qt.pyqtSignal(float)  # 0.0〜1.0
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.project: Project = None
+        self.journal_seq = 0  # ジャーナルを再生し終えたところの通し番号
+        self.numberings = None  # ジャーナルを再生し終えたときの各レイヤーの Layer.numbering（Journal.track）
+        self.error = None  # 読み込めなかったときのメッセージ
+
+    def run(self):
+        # ファイルの解析と、表示するレイヤーの領域づくりまでをこのスレッドで行う
+        import json
+        try:
+            if is_binary_project(self.path):
+                self.project = Project.from_binary(self.path, prepare=False)
+            else:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    json_data = json.loads(f.read())
+                self.project = Project.from_json(json_data, prepare=False)
+            # 前回の保存のあとの操作をジャーナルから再生する（操作の領域インデックスはファイルと同じ並びなので、領域を作る前に）
+            self.journal_seq = replay_journal(self.project, self.path)
+            self.numberings = [layer.numbering for layer in self.project.layers]
+            self.project.prepare(self.progressChanged.emit)
+        except Exception as e:
+            # 壊れたファイルはどんな例外になるかわからないので、すべて読み込みエラーとして伝える
+            self.project = None
+            self.error = str(e) or type(e).__name__
+        finally:
+            self.finished.emit()
+
+class ProjectSaveWorker(qt.QObject):
+    finished = qt.pyqtSignal()
+    progressChanged = qt.pyqtSignal(float)  # 0.0〜1.0
+
+    def __init__(self, project: Project, path):
+        super().__init__()
+        self.project = project  # 保存を始めたときに写し取ったもの（GUI 側の編集の影響を受けない）
+        self.path = path
+        self.error = None  # 保存できなかったときのメッセージ
+
+    def run(self):
+        try:
+            self.project.save(self.path, self.progressChanged.emit)
+        except Exception as e:
+            self.error = str(e) or type(e).__name__
+        finally:
+            self.finished.emit()
 
 class MainWindow(QMainWindow):
     canvas: Canvas = None
+    LAYER_IDLE_SECONDS = 60  # これだけ使われなかった非アクティブなレイヤーは領域を手放す
+    AUTOSAVE_INTERVAL_MS = 2000  # 変更をジャーナルに書き足す間隔
+    JOURNAL_COMPACT_BYTES = 4 << 20  # ジャーナルがこれより大きくなったら、プロジェクトファイルに畳み込む
 
     def __init__(self):
         super().__init__()
@@ -68,6 +138,19 @@ class MainWindow(QMainWindow):
         export_canvas_action.triggered.connect(self.save_canvas_dialog)
         file_menu.addAction(export_canvas_action)
 
+        edit_menu = QMenu("編集", self)
+        self.menu_bar.addMenu(edit_menu)
+
+        undo_action = QAction("元に戻す", self)
+        undo_action.setShortcut(QKeySequence.StandardKey.Undo)
+        undo_action.triggered.connect(lambda: self.canvas and self.canvas.undo())
+        edit_menu.addAction(undo_action)
+
+        redo_action = QAction("やり直し", self)
+        redo_action.setShortcuts([QKeySequence("Ctrl+Y"), QKeySequence("Ctrl+Shift+Z")])
+        redo_action.triggered.connect(lambda: self.canvas and self.canvas.redo())
+        edit_menu.addAction(redo_action)
+
         self.background_color = (255, 255, 255, 255)  # デフォルト白
 
         # 色選択UI（RGBAダイアログ）
@@ -137,20 +220,42 @@ class MainWindow(QMainWindow):
         self.central_widget.setLayout(self.vlayout)
         self.setCentralWidget(self.central_widget)
 
+        # 開いているプロジェクトファイルの操作ログ（保存するまでは None）
+        self.journal: Journal = None
+
         # 初期キャンバス生成（共通化）
         self.init_canvas(800, 600, self.line_count_spin.value())
         self.setWindowFilePath("")  # 初期はファイルパスなし
 
+        # 保存の進み具合（保存中も編集できるよう、ダイアログではなくステータスバーに出す）
+        self.save_thread = None
+        self.save_worker = None
+        self.pending_save = None  # 保存中に来た最新の保存先
+        self.save_progress = QProgressBar()
+        self.save_progress.setRange(0, 100)
+        self.save_progress.setMaximumWidth(160)
+        self.save_progress.hide()
+        self.statusBar().addPermanentWidget(self.save_progress)
+
+        # しばらく使っていない非アクティブなレイヤーの領域を手放す
+        self.release_timer = qt.QTimer(self)
+        self.release_timer.timeout.connect(self.release_idle_layers)
+        self.release_timer.start(self.LAYER_IDLE_SECONDS * 1000 // 2)
+
+        # 変更をジャーナルに少しずつ書き足す
+        self.autosave_timer = qt.QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_timer.start(self.AUTOSAVE_INTERVAL_MS)
+
     def init_canvas(self, w, h, n):
         # キャンバスのクリア＋リサイズ
+        self.close_journal()
         if self.canvas:
             self.canvas.setParent(None)
-        self.canvas = Canvas(w, h, self)
-        self.canvas.layers = [Layer("Layer 1")]
-        lines = generate_lines(w, h, count=n)
-        self.canvas.layers[0].lines = lines
-        self.canvas.layers[0].regions = create_regions(w, h, lines)
-        self.canvas.layers[0].line_width = self.line_width_spin.value()
+        layer = Layer("Layer 1")
+        layer.generate(w, h, count=n)
+        layer.line_width = self.line_width_spin.value()
+        self.canvas = Canvas(w, h, self, grid=layer.grid, layers=[layer])
         self.left_vlayout.insertWidget(1, self.canvas)
         # レイヤー初期化
         self.layer_list.clear()
@@ -182,7 +287,11 @@ class MainWindow(QMainWindow):
                 item.setCheckState(qt.Qt.CheckState.Checked)
                 self.canvas.layers[idx].visible = True
             else:
-                self.canvas.layers[idx].visible = (item.checkState() == qt.Qt.CheckState.Checked)
+                visible = item.checkState() == qt.Qt.CheckState.Checked
+                if visible and not self.ensure_layer_geometry(idx):
+                    item.setCheckState(qt.Qt.CheckState.Unchecked)
+                    visible = False
+                self.canvas.layers[idx].visible = visible
             self.canvas.update()
 
     def change_line_width(self, value):
@@ -235,10 +344,9 @@ class MainWindow(QMainWindow):
     def add_layer(self):
         if self.canvas:
             name = f"Layer {len(self.canvas.layers)+1}"
-            layer = Layer(name)
-            layer.lines = generate_lines(self.canvas.width(), self.canvas.height(), count=self.line_count_spin.value())
-            layer.regions = create_regions(self.canvas.width(), self.canvas.height(), layer.lines)
-            layer.colored_regions = []
+            layer = Layer(name, grid=self.canvas.grid)
+            w, h = self.canvas.width(), self.canvas.height()
+            layer.generate(w, h, count=self.line_count_spin.value())
             # 新規レイヤーの線色は現在のUIの色
             layer.line_rgba = self.line_rgba
             layer.line_width = self.line_width_spin.value()
@@ -257,6 +365,7 @@ class MainWindow(QMainWindow):
             idx = self.layer_list.currentRow()
             self.layer_list.takeItem(idx)
             self.canvas.layers.pop(idx)
+            self.canvas.history.retain(self.canvas.layers)
 
             self.canvas.active_layer = self.layer_list.currentRow()
             self.canvas.update()
@@ -268,11 +377,35 @@ class MainWindow(QMainWindow):
             self.init_canvas(w, h, n)
             self.setWindowFilePath("")  # ファイルパスをクリア
 
+    def release_idle_layers(self):
+        # タイマーから呼ばれるので、例外は外に出さずに知らせるだけにする（領域を持ち続けるだけで済む）
+        if not self.canvas:
+            return
+        try:
+            self.canvas.release_idle_layers(self.LAYER_IDLE_SECONDS)
+        except Exception as e:
+            self.statusBar().showMessage(f"レイヤーの領域を解放できませんでした: {e}", 5000)
+
+    def ensure_layer_geometry(self, idx) -> bool:
+        """
+        idx 番目のレイヤーを表示する前に領域を作る。塗りが領域と一致しなければ知らせて False を返す
+        """
+        try:
+            self.canvas.layers[idx].ensure_geometry()
+        except ValueError as e:
+            QMessageBox.warning(self, "レイヤーを表示できません", f"{self.canvas.layers[idx].name}: {e}")
+            return False
+        return True
+
     def change_active_layer(self, idx):
         if self.canvas:
+            item = self.layer_list.item(idx)
+            if item and not self.ensure_layer_geometry(idx):
+                # 表示できないレイヤーは選ばせない
+                self.layer_list.setCurrentRow(self.canvas.active_layer)
+                return
             self.canvas.active_layer = idx
             # 選択したレイヤーは必ず表示状態にする
-            item = self.layer_list.item(idx)
             if not item:
                 return
 
@@ -293,17 +426,36 @@ class MainWindow(QMainWindow):
                     if other_widget and hasattr(other_widget, 'checkbox'):
                         other_widget.checkbox.setEnabled(True)
 
+    PROJECT_FILTER = "Project Files (*.json *.ldproj);;JSON Files (*.json);;Binary Project Files (*.ldproj);;All Files (*)"
+
     def open_file_dialog(self):
-        import json
-        path, _ = QFileDialog.getOpenFileName(self, "ファイルを開く", "", "JSON Files (*.json);;All Files (*)")
+        path, _ = QFileDialog.getOpenFileName(self, "ファイルを開く", "", self.PROJECT_FILTER)
         if not path: return 
 
-        self.setWindowFilePath(path)
-        
-        with open(path, 'r', encoding='utf-8') as f:
-            json_data = json.loads(f.read())
+        # 読み込みは別スレッドで行い、そのあいだは進み具合を表示する
+        dlg = ProgressBarDialog(self, title="読み込み中", message="プロジェクトを読み込んでいます...")
+        worker = ProjectLoadWorker(path)
+        thread = qt.QThread()
+        worker.moveToThread(thread)
+        worker.progressChanged.connect(dlg.update_progress)
+        worker.finished.connect(dlg.accept)
+        thread.started.connect(worker.run)
+        thread.start()
 
-        self.canvas.reset_from_json(json_data)
+        dlg.exec()
+
+        thread.quit()
+        thread.wait()
+        if worker.error is not None:
+            QMessageBox.warning(self, "読み込みエラー", worker.error)
+            return
+
+        self.setWindowFilePath(path)
+        self.close_journal()
+        self.canvas.set_project(worker.project)
+        if worker.project.journal_id is not None:
+            self.open_journal(path, worker.project.journal_id, worker.journal_seq, worker.numberings)
+        # ジャーナルのない古い形式のファイルは、次に保存したときからジャーナルを付ける
         # レイヤーの初期化
         self.layer_list.clear()
         for i, layer in enumerate(self.canvas.layers):
@@ -320,32 +472,140 @@ class MainWindow(QMainWindow):
         self.update_line_btn()
 
     def save_file_dialog(self):
-        import json
-        path = QFileDialog.getSaveFileName(self, "名前を付けて保存", "canvas.json", "JSON Files (*.json);;All Files (*)")[0]
+        path = QFileDialog.getSaveFileName(self, "名前を付けて保存", "canvas.json", self.PROJECT_FILTER)[0]
         if not path: return
 
         self.setWindowFilePath(path)
 
-        json_data = self.canvas.to_json()
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(json_data, ensure_ascii=False, indent=2))
+        self.write_project_file(path)
+
+    def write_project_file(self, path):
+        """
+        拡張子に応じて JSON かバイナリ形式でプロジェクトを保存する。
+        いまの状態を写し取って別スレッドで書き出すので、保存中も編集を続けられる
+        """
+        if self.save_thread is not None:
+            # 保存中なら、終わってから最新の状態で保存し直す
+            self.pending_save = path
+            return
+        self.save_progress.setValue(0)
+        self.save_progress.show()
+        self.statusBar().showMessage("保存しています...")
+        self.save_worker = ProjectSaveWorker(self.snapshot_for_save(path), path)
+        self.save_thread = qt.QThread()
+        self.save_worker.moveToThread(self.save_thread)
+        self.save_worker.progressChanged.connect(lambda value: self.save_progress.setValue(int(value * 100)))
+        self.save_worker.finished.connect(self.save_thread.quit)
+        self.save_thread.started.connect(self.save_worker.run)
+        self.save_thread.finished.connect(self.on_save_thread_finished)
+        self.save_thread.start()
+
+    def snapshot_for_save(self, path) -> Project:
+        """
+        path に保存するプロジェクトを写し取る。ここまでの操作をジャーナルに記録し、
+        写しにはジャーナルの id と、写しに入った最後の操作の通し番号を持たせる（保存できたら compact_journal を呼ぶ）
+        """
+        if self.journal is not None and self.journal.path == path:
+            self.journal.sync(self.canvas.layers)
+        else:
+            self.open_journal(path)
+        snapshot = self.canvas.snapshot()
+        snapshot.journal_id = self.journal.token
+        snapshot.journal_seq = self.journal.seq
+        return snapshot
+
+    def compact_journal(self, snapshot: Project, path):
+        # 保存できた写しに入った分をジャーナルから除く
+        if self.journal is not None and self.journal.path == path:
+            self.journal.compact(snapshot.journal_seq)
+
+    def on_save_thread_finished(self):
+        error = self.save_worker.error
+        if error is None:
+            self.compact_journal(self.save_worker.project, self.save_worker.path)
+        # finished が届いてもスレッドはまだ後始末の途中のことがあるので、止まりきるのを待ってから手放す
+        self.save_thread.wait()
+        self.save_thread.deleteLater()
+        self.save_thread = None
+        self.save_worker = None
+        self.save_progress.hide()
+        if error is not None:
+            self.statusBar().clearMessage()
+            QMessageBox.warning(self, "保存エラー", error)
+        else:
+            self.statusBar().showMessage("保存しました", 3000)
+        if self.pending_save is not None:
+            path, self.pending_save = self.pending_save, None
+            self.write_project_file(path)
+
+    def closeEvent(self, event):
+        # 保存中なら書き終わるのを待つ（まだ始めていない保存はここで済ませる）
+        if self.save_thread is not None:
+            self.save_thread.quit()
+            self.save_thread.wait()
+            # 閉じたあとは終わりの知らせを受け取らないので、後始末はここでする
+            self.save_thread.finished.disconnect(self.on_save_thread_finished)
+            worker, self.save_worker, self.save_thread = self.save_worker, None, None
+            if worker.error is None:
+                self.compact_journal(worker.project, worker.path)
+            else:
+                QMessageBox.warning(self, "保存エラー", worker.error)
+            if self.pending_save is not None:
+                path, self.pending_save = self.pending_save, None
+                try:
+                    snapshot = self.snapshot_for_save(path)
+                    snapshot.save(path)
+                    self.compact_journal(snapshot, path)
+                except Exception as e:
+                    # 書けなくてもジャーナルは閉じる（変更はジャーナルに残る）
+                    QMessageBox.warning(self, "保存エラー", str(e) or type(e).__name__)
+        self.close_journal()
+        super().closeEvent(event)
+
+    def open_journal(self, path, token=None, seq=0, numberings=None):
+        """
+        path のジャーナルを開き、いまの状態を記録済みとする（token を省くと新しく作る）。
+        numberings は Journal.track と同じ
+        """
+        self.close_journal()
+        self.journal = Journal(path, token, seq)
+        self.journal.track(self.canvas.layers, numberings)
+
+    def close_journal(self):
+        # 記録していない変更を書き足してから閉じる
+        if self.journal is not None:
+            self.journal.sync(self.canvas.layers)
+            self.journal.close()
+            self.journal = None
+
+    def autosave(self):
+        """
+        前回からの変更をジャーナルに書き足す。ジャーナルが大きくなったらプロジェクトファイルに畳み込む
+        """
+        if self.journal is None:
+            return
+        self.journal.sync(self.canvas.layers)
+        if self.save_thread is None and self.journal.size >= self.JOURNAL_COMPACT_BYTES:
+            self.write_project_file(self.journal.path)
 
     def save_canvas_dialog(self):
         if not self.canvas:
             return
         # プレビュー付きダイアログ
-        dlg = ExportCanvasDialog(self, create_preview_image=lambda antialiasing, progress_callback: self.canvas.to_qimage(antialiasing, progress_callback))
+        dlg = ExportCanvasDialog(self, create_preview_image=lambda antialiasing, progress_callback, width, height, min_feature, cancel: self.canvas.preview_qimage(width, height, antialiasing, min_feature, progress_callback, cancel))
         if not dlg.exec():
             return
         path = dlg.get_params()
         if not path:
             return
         
-        dlg2 = ProgressBarDialog(self, title="エクスポート中", message="キャンバスを保存しています...")
-        worker = CanvasExportWorker(self.canvas, path, antialiasing=dlg.is_antialiasing_enabled(), progress_callback=lambda p: dlg2.update_progress(p))
+        dlg2 = ProgressBarDialog(self, title="エクスポート中", message="キャンバスを保存しています...", cancellable=True)
+        worker = CanvasExportWorker(self.canvas, path, antialiasing=dlg.is_antialiasing_enabled(), scale=dlg.get_scale())
         thread = qt.QThread()
         worker.moveToThread(thread)
+        worker.progressChanged.connect(dlg2.update_progress)
         worker.finished.connect(dlg2.accept)
+        dlg2.canceled.connect(worker.cancel_token.cancel)
         thread.started.connect(worker.run)
         thread.start()
 
@@ -355,25 +615,29 @@ class MainWindow(QMainWindow):
         thread.wait()
 
     def save_overwrite_file(self):
-        import json
         if not self.canvas:
             return
         if self.windowFilePath() == "":
             self.save_file_dialog()
             return
         path = self.windowFilePath()
-        with open(path, 'w', encoding='utf-8') as f:
-            json_data = self.canvas.to_json()
-            f.write(json.dumps(json_data, ensure_ascii=False, indent=2))
+        if self.journal is not None and self.journal.path == path:
+            # 変更はジャーナルに書き足すだけで済ませる（全体はジャーナルが大きくなってから書き直す）
+            self.autosave()
+            if self.save_thread is None:
+                self.statusBar().showMessage("保存しました", 3000)
+            return
+        self.write_project_file(path)
 
     def regenerate_active_layer(self):
         if self.canvas and 0 <= self.canvas.active_layer < len(self.canvas.layers):
             layer = self.canvas.layers[self.canvas.active_layer]
             w, h = self.canvas.width(), self.canvas.height()
             n = self.line_count_spin.value()
-            layer.lines = generate_lines(w, h, count=n)
-            layer.regions = create_regions(w, h, layer.lines)
-            layer.colored_regions = []
+            change = LineChange(layer)
+            layer.generate(w, h, count=n)
+            change.finish()
+            self.canvas.history.push(change)
             self.canvas.update()
 
     def open_layer_properties_dialog(self):
@@ -419,6 +683,7 @@ class LayerListItemWidget(QWidget):
         dlg = LayerPropertiesDialog(self.parent, layer_name=layer.name)
         # 初期値として現在のsave_modeを反映
         dlg.save_mode_radios[getattr(layer, 'save_mode', 0)].setChecked(True)
+        dlg.merge_fills_checkbox.setChecked(layer.merge_fills)
         if dlg.exec():
             new_name = dlg.get_name()
             layer.name = new_name
@@ -426,11 +691,18 @@ class LayerListItemWidget(QWidget):
             # 保存モードも反映
             mode_idx = dlg.get_save_mode()
             layer.save_mode = mode_idx
+            layer.merge_fills = dlg.get_merge_fills()
 
     def toggle_layer_visible(self, state):
         if not self.parent.canvas or self.idx >= len(self.parent.canvas.layers):
             return
         layer = self.parent.canvas.layers[self.idx]
+        if state and not self.parent.ensure_layer_geometry(self.idx):
+            # 表示できないレイヤーは非表示のままにする
+            self.checkbox.blockSignals(True)
+            self.checkbox.setChecked(False)
+            self.checkbox.blockSignals(False)
+            return
         layer.visible = bool(state)
         self.parent.canvas.update()
 
@@ -0,0 +1,78 @@
+import struct
+import zlib
+
+import numpy as np
+
+class PngWriter:
+    """
+    RGBA 8bit の PNG を行ごとに書き出す。
+    行を受け取るたびに圧縮して IDAT チャンクとして書くので、画像全体をメモリに持たなくてよい
+    """
+    _CHUNK_SIZE = 1 << 20  # IDAT 1つあたりの目安の大きさ
+
+    def __init__(self, path, width, height, compress_level=6):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self._file = open(path, 'wb')
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+        self._file.write(b'\x89PNG\r\n\x1a\n')
+        # 8bit, カラータイプ6 (RGBA), 圧縮0, フィルタ0, インターレースなし
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        (行数, 幅, 4) の uint8 配列を書き足す
+        """
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.ndim != 3 or rows.shape[1:] != (self.width, 4):
+            raise ValueError("行の大きさが画像の幅と一致しません。")
+        if self.rows_written + len(rows) > self.height:
+            raise ValueError("画像の高さを超えて行を書き込もうとしました。")
+        # 各行の先頭にフィルタ種別 0（なし）を付ける
+        raw = np.zeros((len(rows), self.width * 4 + 1), dtype=np.uint8)
+        raw[:, 1:] = rows.reshape(len(rows), -1)
+        self._push(self._compressor.compress(raw.tobytes()))
+        self.rows_written += len(rows)
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self.rows_written != self.height:
+            self._file.close()
+            raise ValueError("書き込んだ行数が画像の高さと一致しません。")
+        self._push(self._compressor.flush())
+        self._flush_idat()
+        self._write_chunk(b'IEND', b'')
+        self._file.close()
+
+    def _push(self, data: bytes):
+        if not data:
+            return
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self._CHUNK_SIZE:
+            self._flush_idat()
+
+    def _flush_idat(self):
+        if self._pending:
+            self._write_chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def _write_chunk(self, kind: bytes, data: bytes):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(kind)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
@@ -1,9 +1,12 @@
+from PyQt6.QtCore import pyqtSignal
 from PyQt6.QtWidgets import (
-    QVBoxLayout, QLabel, QVBoxLayout, QLabel, QDialog, QProgressBar
+    QVBoxLayout, QLabel, QVBoxLayout, QLabel, QDialog, QProgressBar, QPushButton
 )
 
 class ProgressBarDialog(QDialog):
-    def __init__(self, parent=None, title="Progress", message="Processing..."):
+    canceled = pyqtSignal()
+
+    def __init__(self, parent=None, title="Progress", message="Processing...", cancellable=False):
         super().__init__(parent)
         self.setWindowTitle(title)
         self.setModal(True)
@@ -12,7 +15,29 @@ class ProgressBarDialog(QDialog):
         layout.addWidget(self.label)
         self.progress_bar = QProgressBar()
         layout.addWidget(self.progress_bar)
+        self.cancel_button = None
+        if cancellable:
+            self.cancel_button = QPushButton("キャンセル")
+            self.cancel_button.clicked.connect(self.cancel)
+            layout.addWidget(self.cancel_button)
         self.setLayout(layout)
 
     def update_progress(self, value):
-        self.progress_bar.setValue(value)
+        """
+        進み具合 (0.0〜1.0) を表示する
+        """
+        self.progress_bar.setValue(int(value * 100))
+
+    def cancel(self):
+        # 処理に取り消しを伝え、止まるまではボタンを押せなくする
+        if self.cancel_button:
+            self.cancel_button.setEnabled(False)
+        self.label.setText("キャンセルしています...")
+        self.canceled.emit()
+
+    def reject(self):
+        # Esc やウィンドウを閉じる操作もキャンセルとして扱う（閉じるのは処理が止まってから）
+        if self.cancel_button:
+            self.cancel()
+        else:
+            super().reject()
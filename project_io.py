@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+BINARY_EXTENSION = '.ldproj'
+MAGIC = b'LDPROJ\x00\x00'
+VERSION = 1
+_ALIGN = 64  # 配列の先頭をそろえる境界（バイト）
+_PREAMBLE = struct.Struct('<IQ')  # バージョン, ヘッダーの長さ
+
+def is_binary_project(path) -> bool:
+    """
+    バイナリ形式のプロジェクトファイルのパスか
+    """
+    return str(path).lower().endswith(BINARY_EXTENSION)
+
+@contextmanager
+def atomic_replace(path):
+    """
+    path と同じフォルダーに作った一時ファイルのパスを渡し、ブロックを正常に抜けたら path と差し替える。
+    途中で失敗したら一時ファイルを消すので、元のファイルは壊れない
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    os.close(fd)
+    try:
+        if os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)  # mkstemp は本人しか読めない権限で作る
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _align(offset: int) -> int:
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+def write_project(path, header: dict, arrays: dict):
+    """
+    プロジェクトをバイナリ形式で書き出す。
+    マジック, (バージョン, ヘッダー長), JSON ヘッダー, 64バイト境界にそろえた配列の生データ の順に並べる。
+    ヘッダーには header と、各配列の位置・型・形を入れる
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    descriptors = {}
+    offset = 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        descriptors[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        offset += array.nbytes
+    header_bytes = json.dumps({'header': header, 'arrays': descriptors}, ensure_ascii=False).encode('utf-8')
+    data_start = _align(len(MAGIC) + _PREAMBLE.size + len(header_bytes))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_PREAMBLE.pack(VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.write(b'\x00' * (data_start + descriptors[name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+
+def read_project(path, mmap=True):
+    """
+    バイナリ形式のプロジェクトを読み込み、(header, 配列の dict) を返す。
+    mmap=True なら配列はファイルをメモリマップした読み取り専用のビューになる
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("プロジェクトファイルの形式が正しくありません。")
+        version, header_len = _PREAMBLE.unpack(f.read(_PREAMBLE.size))
+        if version != VERSION:
+            raise ValueError("対応していないバージョンのプロジェクトファイルです。")
+        meta = json.loads(f.read(header_len).decode('utf-8'))
+    data_start = _align(len(MAGIC) + _PREAMBLE.size + header_len)
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+    arrays = {}
+    for name, desc in meta['arrays'].items():
+        dtype = np.dtype(desc['dtype'])
+        start = data_start + desc['offset']
+        count = int(np.prod(desc['shape'], dtype=np.int64))
+        arrays[name] = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(desc['shape'])
+    return meta['header'], arrays
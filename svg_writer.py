@@ -0,0 +1,99 @@
+import gzip
+from typing import Iterable
+
+import numpy as np
+
+def svg_color(rgba):
+    """
+    RGBA を SVG の色指定にする（不透明なら rgb()、そうでなければ rgba()）
+    """
+    r, g, b, a = rgba
+    return f'rgba({r},{g},{b},{a/255:.2f})' if a < 255 else f'rgb({r},{g},{b})'
+
+class SvgWriter:
+    """
+    SVG を少しずつファイルに書き出す。
+    図形は相対座標の <path d=...> で書き、同じ見た目の図形は <g> にまとめてスタイルを共有する。
+    compress=True（または拡張子が .svgz）なら gzip で圧縮して書く
+    """
+
+    def __init__(self, path, width, height, precision=1, compress=None):
+        if compress is None:
+            compress = str(path).lower().endswith('.svgz')
+        self.precision = precision
+        self._scale = 10 ** precision
+        if compress:
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self._file = open(path, 'w', encoding='utf-8')
+        self._file.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # 途中で失敗したときは閉じるだけ（書きかけのファイルは呼び出し側で消す）
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write('</svg>\n')
+        self._file.close()
+        self._file = None
+
+    def begin_group(self, **attrs):
+        """
+        <g> を開く。属性名の _ は - にする（stroke_width -> stroke-width）
+        """
+        text = ' '.join(f'{k.replace("_", "-")}="{v}"' for k, v in attrs.items())
+        self._file.write(f'<g {text}>\n' if text else '<g>\n')
+
+    def end_group(self):
+        self._file.write('</g>\n')
+
+    def path(self, coords, closed=False):
+        """
+        座標列を1つの <path> として書く
+        """
+        self._file.write(f'<path d="{self.path_data(coords, closed)}"/>\n')
+
+    def polygon(self, polygon):
+        """
+        穴のあるポリゴンを、外周と穴を部分パスにした1つの <path> として書く（fill-rule は evenodd を想定）
+        """
+        rings = [polygon.exterior, *polygon.interiors]
+        d = ''.join(self.path_data(ring.coords, closed=True) for ring in rings)
+        self._file.write(f'<path d="{d}"/>\n')
+
+    def paths(self, coords_list: Iterable, closed=False):
+        for coords in coords_list:
+            self.path(coords, closed)
+
+    def path_data(self, coords, closed=False) -> str:
+        """
+        座標列を相対座標の path データにする。
+        先に絶対座標を丸めてから差分を取るので、丸め誤差は積み重ならない
+        """
+        q = np.round(np.asarray(coords, dtype=float).reshape(-1, 2) * self._scale).astype(np.int64)
+        if closed and len(q) > 1 and (q[0] == q[-1]).all():
+            q = q[:-1]
+        d = np.diff(q, axis=0)
+        d = d[(d != 0).any(axis=1)]
+        fmt = self._format
+        head = f'M{fmt(q[0, 0])} {fmt(q[0, 1])}'
+        body = ' '.join(f'{fmt(dx)} {fmt(dy)}' for dx, dy in d.tolist())
+        return head + (f'l{body}' if body else '') + ('z' if closed else '')
+
+    def _format(self, value: int) -> str:
+        # 固定小数点の整数を、末尾の0を省いた10進表記にする
+        if self.precision == 0:
+            return str(value)
+        sign = '-' if value < 0 else ''
+        whole, frac = divmod(abs(int(value)), self._scale)
+        frac_text = str(frac).rjust(self.precision, '0').rstrip('0')
+        return f'{sign}{whole}.{frac_text}' if frac_text else f'{sign}{whole}'